@@ -1,29 +1,56 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Depends, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 import os
 import time
-from PIL import Image
-from io import BytesIO
+import asyncio
+from PIL import Image, ImageFilter, ImageOps
 from pathlib import Path
 import hashlib
+import hmac
 import json
-import requests
-from typing import List, Optional
+import uuid
+import shutil
+import math
+import random
+import httpx
+import aiofiles
+import numpy as np
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import bisect
+import functools
 import logging
+import socket
+import sqlite3
+import threading
 from functools import lru_cache
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Request IDs are carried through the logs via a context variable
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
 # Configure logging
+log_handler = logging.StreamHandler()
+log_handler.addFilter(RequestIdFilter())
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()]
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s",
+    handlers=[log_handler]
 )
 logger = logging.getLogger("casla-quartz-api")
 
@@ -37,63 +64,267 @@ app = FastAPI(
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# Serve static files from React build
-app.mount("/static", StaticFiles(directory="frontend/build/static"), name="static")
+# Prometheus-style metrics
+class Metric:
+    kind = "untyped"
 
-@app.get("/{path:path}")
-async def serve_frontend(path: str):
-    return FileResponse("frontend/build/index.html")
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+
+    def _labels(self, labelvalues: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labelvalues)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(labels)} {value}" for labels, value in sorted(self.values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    """A gauge whose value is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float]):
+        super().__init__(name, description)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.callback()}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = ()):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        self.counts: Dict[tuple, List[int]] = {}
+        self.sums: Dict[tuple, float] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        counts = self.counts.setdefault(labelvalues, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labelvalues] = self.sums.get(labelvalues, 0) + value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = self._labels(labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+metrics = MetricsRegistry()
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+STAGE_DURATION = metrics.register(Histogram(
+    "casla_stage_duration_seconds", "Time spent in each pipeline stage", ("stage",), LATENCY_BUCKETS
+))
+HTTP_REQUEST_DURATION = metrics.register(Histogram(
+    "casla_http_request_duration_seconds", "API request latency", ("method", "route", "status"), LATENCY_BUCKETS
+))
+POLL_ITERATIONS = metrics.register(Counter(
+    "casla_poll_iterations_total", "Upstream status checks", ("strategy",)
+))
+UPSTREAM_RESPONSES = metrics.register(Counter(
+    "casla_upstream_responses_total", "Upstream responses by status code", ("method", "status")
+))
+UPSTREAM_TIMEOUTS = metrics.register(Counter(
+    "casla_upstream_timeouts_total", "Upstream jobs that exceeded UPSTREAM_JOB_TIMEOUT", ("strategy",)
+))
+CACHE_REQUESTS = metrics.register(Counter(
+    "casla_cache_requests_total", "Cache lookups", ("cache", "result")
+))
+
+EVENT_LOOP_LAG = metrics.register(Histogram(
+    "casla_event_loop_lag_seconds", "How late the event loop woke a periodic timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
+def process_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+metrics.register(Gauge("casla_process_resident_memory_bytes", "Resident memory of this worker", process_rss_bytes))
+
+async def monitor_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL))
+
+@contextmanager
+def observe_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage)
+
+def timed_stage(stage: str):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with observe_stage(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Progress reporting: pipeline code announces stage changes to whoever is listening in
+# the current context (a job, or every job sharing a single-flight call)
+progress_var: ContextVar[Optional[Callable[[str, dict], None]]] = ContextVar("progress", default=None)
+
+def report_progress(stage: str, **detail):
+    reporter = progress_var.get()
+    if reporter is not None:
+        reporter(stage, detail)
+
+class ProgressFanout:
+    """Forwards progress to several listeners and replays the latest stage to late joiners."""
+
+    def __init__(self):
+        self.listeners: List[Callable[[str, dict], None]] = []
+        self.latest: Optional[tuple] = None
+
+    def __call__(self, stage: str, detail: dict):
+        self.latest = (stage, detail)
+        for listener in list(self.listeners):
+            listener(stage, detail)
+
+    def add(self, listener: Callable[[str, dict], None]):
+        self.listeners.append(listener)
+        if self.latest is not None:
+            listener(*self.latest)
+
+    def remove(self, listener: Callable[[str, dict], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    request_id = request.headers.get("x-request-id", "")[:64] or uuid.uuid4().hex[:16]
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        response.headers["X-Request-ID"] = request_id
+        client = getattr(request.state, "client", None)
+        if client is not None:
+            # Declared lengths only: streamed responses carry none and are not counted
+            admission.record(
+                client,
+                bytes_in=int(request.headers.get("content-length") or 0),
+                bytes_out=int(response.headers.get("content-length") or 0)
+            )
+        return response
+    finally:
+        route = request.scope.get("route")
+        if route is not None and route.path.startswith("/api/"):
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, request.method, route.path, status)
+        request_id_var.reset(token)
+
+# Paths default to the repository layout, wherever the process is started from
+BASE_DIR = Path(__file__).resolve().parent.parent
+FRONTEND_BUILD_DIR = Path(os.getenv("FRONTEND_BUILD_DIR", str(BASE_DIR / "frontend" / "build")))
+
+# Serve static files from React build; the API runs without it
+if (FRONTEND_BUILD_DIR / "static").is_dir():
+    app.mount("/static", StaticFiles(directory=str(FRONTEND_BUILD_DIR / "static")), name="static")
+else:
+    logger.info(f"No frontend build in {FRONTEND_BUILD_DIR}, serving the API only")
 
 # Configuration
 SAVE_DIR = os.getenv("SAVE_DIR", "/tmp/generated_images")
 API_KEY_TOKEN = os.getenv("API_KEY_TOKEN")
+# Bearer token for /metrics and the stats endpoints; without it they take a client key,
+# or are served to loopback callers only when no client keys are configured either
+OPS_TOKEN = os.getenv("OPS_TOKEN", "")
 URL_PRE = os.getenv("URL_PRE")
+RESOURCE_EXPIRE_SEC = int(os.getenv("RESOURCE_EXPIRE_SEC", "7200"))
+RESOURCE_SYNC_DELAY = float(os.getenv("RESOURCE_SYNC_DELAY", "3"))
 Path(SAVE_DIR).mkdir(exist_ok=True, parents=True)
 
-# Product image mapping
-PRODUCT_IMAGE_MAP = {
-    "C1012 Glacier White": "product_images/C1012.jpg",
-    "C1026 Polar": "product_images/C1026.jpg",
-    "C3269 Ash Grey": "product_images/C3269.jpg",
-    "C3168 Silver Wave": "product_images/C3168.jpg",
-    "C1005 Milky White": "product_images/C1005.jpg",
-    "C2103 Onyx Carrara": "product_images/C2103.jpg",
-    "C2104 Massa": "product_images/C2104.jpg",
-    "C3105 Casla Cloudy": "product_images/C3105.jpg",
-    "C3146 Casla Nova": "product_images/C3146.jpg",
-    "C2240 Marquin": "product_images/C2240.jpg",
-    "C2262 Concrete (Honed)": "product_images/C2262.jpg",
-    "C3311 Calacatta Sky": "product_images/C3311.jpg",
-    "C3346 Massimo": "product_images/C3346.jpg",
-    "C4143 Mario": "product_images/C4143.jpg",
-    "C4145 Marina": "product_images/C4145.jpg",
-    "C4202 Calacatta Gold": "product_images/C4202.jpg",
-    "C1205 Casla Everest": "product_images/C1205.jpg",
-    "C4211 Calacatta Supreme": "product_images/C4211.jpg",
-    "C4204 Calacatta Classic": "product_images/C4204.jpg",
-    "C1102 Super White": "product_images/C1102.jpg",
-    "C4246 Casla Mystery": "product_images/C4246.jpg",
-    "C4345 Oro": "product_images/C4345.jpg",
-    "C4346 Luxe": "product_images/C4346.jpg",
-    "C4342 Casla Eternal": "product_images/C4342.jpg",
-    "C4221 Athena": "product_images/C4221.jpg",
-    "C4255 Calacatta Extra": "product_images/C4255.jpg",
-}
-
-# Dependency for API key validation
-def verify_api_key():
+# Dependency for API key validation: authenticates the caller, then applies its rate limit
+def verify_api_key(request: Request) -> str:
     if not API_KEY_TOKEN:
         raise HTTPException(
             status_code=500,
             detail="API key not configured. Please set the API_KEY_TOKEN environment variable."
         )
-    return API_KEY_TOKEN
+    client = admission.authenticate(request)
+    # Read back by request_context to account the bytes this request moved
+    request.state.client = client
+    admission.admit(client)
+    return client
+
+def verify_ops_access(request: Request):
+    # Operational endpoints describe the whole deployment, not just the caller
+    if not OPS_TOKEN:
+        if admission.enforcing:
+            verify_api_key(request)
+            return
+        # Neither secret configured: the API itself is open, so keep these to this machine
+        if not request.client or request.client.host not in ("127.0.0.1", "::1"):
+            raise HTTPException(status_code=403, detail="Set OPS_TOKEN to read this from another host")
+        return
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), OPS_TOKEN.encode()):
+        raise HTTPException(
+            status_code=401,
+            detail="An operator token is required",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+def get_caller_id(request: Request) -> str:
+    # Without CLIENT_KEYS: the caller's Authorization header when present, otherwise its address
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return "key:" + hashlib.sha256(authorization.encode()).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+def get_client_id(client: str = Depends(verify_api_key)) -> str:
+    # Fair-share, quota and accounting key; FastAPI runs verify_api_key once per request
+    return client
 
 # Pydantic models
 class GenerateRequest(BaseModel):
@@ -108,6 +339,15 @@ class Img2ImgRequest(BaseModel):
     custom_size: Optional[str] = Field(None, description="Custom size (e.g., '1280x720')")
     product_codes: List[str] = Field(..., description="Selected product codes")
 
+class PreviewRequest(BaseModel):
+    position: str = Field(..., description="Position the room was rendered with")
+    product_codes: List[str] = Field(..., description="Product to preview; only the first is used")
+
+class BatchText2ImgRequest(BaseModel):
+    prompt: str = Field(..., description="Text prompt shared by every variant")
+    product_codes: List[str] = Field(..., description="Product codes to render, one variant each")
+    sizes: List[str] = Field(["1024x768"], description="Image sizes (e.g., '1024x768'), one variant each")
+
 class ApiResponse(BaseModel):
     success: bool
     message: str
@@ -115,30 +355,33 @@ class ApiResponse(BaseModel):
 
 # Endpoints with /api/ prefix
 @app.post("/api/text2img", summary="Generate image from text prompt", response_class=FileResponse)
-async def text2img(request: GenerateRequest, api_key: str = Depends(verify_api_key)):
+async def text2img(
+    request: GenerateRequest,
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
+):
     try:
-        # Validate size
-        width, height = parse_size(request.size_choice, request.custom_size)
-
-        # Rewrite prompt with Groq
-        rewritten_prompt = rewrite_prompt_with_groq(request.prompt, request.product_codes)
-        logger.info(f"Rewritten prompt: {rewritten_prompt}")
-
-        # Generate image using txt2img function
-        result = txt2img(rewritten_prompt, width, height, request.product_codes)
+        parse_size(request.size_choice, request.custom_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        if isinstance(result, str):
-            raise HTTPException(status_code=500, detail=result)
-
-        # Save and return the image
-        save_path = Path(SAVE_DIR) / f"{hashlib.md5(request.prompt.encode()).hexdigest()}.png"
-        result.save(save_path)
+    try:
+        request.product_codes = resolve_product_codes(request.product_codes)
+        upstream_scheduler.check_capacity()
+        reserved = await reserve_text2img(request, client_id)
+        try:
+            save_path = await generate_text2img(request, client_id)
+        finally:
+            if reserved:
+                admission.release(client_id)
         return FileResponse(
-            path=str(save_path),
+            path=save_path,
             media_type="image/png",
             filename="generated_image.png"
         )
 
+    except (HTTPException, SchedulerFull):
+        raise
     except Exception as e:
         logger.error(f"Error in text2img: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -147,28 +390,25 @@ async def text2img(request: GenerateRequest, api_key: str = Depends(verify_api_k
 async def img2img(
     image: UploadFile = File(...),
     request: Img2ImgRequest = Depends(),
-    api_key: str = Depends(verify_api_key)
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
 ):
     try:
-        # Validate size
-        width, height = parse_size(request.size_choice, request.custom_size)
+        parse_size(request.size_choice, request.custom_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Save uploaded image
-        image_path = Path(SAVE_DIR) / f"input_{int(time.time())}.jpg"
-        with open(image_path, "wb") as f:
-            f.write(await image.read())
-
-        logger.info(f"Saved input image to {image_path}")
-
-        # Upload image to TensorArt
-        image_resource_id = upload_image_to_tensorart(str(image_path))
-        if not image_resource_id:
-            raise HTTPException(status_code=500, detail="Failed to upload input image.")
+    try:
+        request.product_codes = resolve_product_codes(request.product_codes, need_texture=True)
+        upstream_scheduler.check_capacity()
 
-        # Generate mask and apply texture
-        output_path = generate_mask(image_resource_id, request.position, request.product_codes[0])
-        if not output_path:
-            raise HTTPException(status_code=500, detail="Failed to generate image.")
+        image_path = await save_upload(image)
+        reserved = await reserve_img2img(image_path, request, client_id)
+        try:
+            output_path = await generate_img2img(image_path, request, client_id)
+        finally:
+            if reserved:
+                admission.release(client_id)
 
         # Return the generated image
         return FileResponse(
@@ -177,10 +417,294 @@ async def img2img(
             filename="output_image.jpg"
         )
 
+    except (HTTPException, SchedulerFull):
+        raise
     except Exception as e:
         logger.error(f"Error in img2img: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+# Asynchronous job endpoints: submit returns immediately, clients poll status/result
+@app.post("/api/jobs/text2img", summary="Submit a text2img job", response_model=ApiResponse, status_code=202)
+async def submit_text2img_job(
+    request: GenerateRequest,
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
+):
+    try:
+        parse_size(request.size_choice, request.custom_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    request.product_codes = resolve_product_codes(request.product_codes)
+
+    upstream_scheduler.check_capacity()
+    reserved = await reserve_text2img(request, client_id)
+    job = submit_job("text2img", {"request": request, "client_id": client_id, "reserved": reserved})
+    return ApiResponse(success=True, message="Job queued", data=describe_new_job(job))
+
+@app.post("/api/jobs/img2img", summary="Submit an img2img job", response_model=ApiResponse, status_code=202)
+async def submit_img2img_job(
+    image: UploadFile = File(...),
+    request: Img2ImgRequest = Depends(),
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
+):
+    try:
+        parse_size(request.size_choice, request.custom_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    request.product_codes = resolve_product_codes(request.product_codes, need_texture=True)
+
+    upstream_scheduler.check_capacity()
+    image_path = await save_upload(image)
+    reserved = await reserve_img2img(image_path, request, client_id)
+    job = submit_job("img2img", {"request": request, "image_path": image_path, "client_id": client_id,
+                                 "reserved": reserved})
+    return ApiResponse(success=True, message="Job queued", data=describe_new_job(job))
+
+@app.get("/api/jobs/{job_id}", summary="Get job status", response_model=ApiResponse)
+async def get_job_status(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="Seconds to wait for the job to finish before answering"),
+    client_id: str = Depends(get_client_id)
+):
+    job = await get_job_or_404(job_id, client_id)
+    if wait and not job.is_finished:
+        job = await job_manager.wait(job, wait)
+    return ApiResponse(success=job.status != "failed", message=job.status, data=job.to_dict())
+
+@app.get("/api/jobs/{job_id}/result", summary="Download job result", response_class=FileResponse)
+async def get_job_result(job_id: str, client_id: str = Depends(get_client_id)):
+    job = await get_job_or_404(job_id, client_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error or "Job failed")
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if not Path(job.result_path).is_file():
+        # Storage may evict results before the job record expires
+        raise HTTPException(status_code=410, detail="The result has expired, please resubmit the job")
+    return FileResponse(
+        path=job.result_path,
+        media_type=job.media_type,
+        filename=f"{job.kind}_{job.id}{Path(job.result_path).suffix}"
+    )
+
+@app.delete("/api/jobs/{job_id}", summary="Cancel a job", response_model=ApiResponse)
+async def cancel_job(job_id: str, client_id: str = Depends(get_client_id)):
+    job = await get_job_or_404(job_id, client_id)
+    if not await job_manager.cancel(job):
+        if job.is_finished:
+            raise HTTPException(status_code=409, detail=f"Job is already {job.status}")
+        raise HTTPException(status_code=409, detail="Job has already been sent to TensorArt and can't be cancelled")
+    message = "Job cancelled" if job.is_local else "Cancellation requested"
+    return ApiResponse(success=True, message=message, data=job.to_dict())
+
+@app.get("/api/jobs/{job_id}/events", summary="Stream job progress as Server-Sent Events")
+async def get_job_events(
+    job_id: str,
+    request: Request,
+    token: Optional[str] = Query(None, description="Token from the job's events_url, for clients that cannot send headers")
+):
+    if token is None:
+        job = await get_job_or_404(job_id, verify_api_key(request))
+    else:
+        # The token only opens this job's events, so it is safe in URLs and access logs
+        job = await job_manager.lookup(job_id)
+        if job is None or not admission.check_job_token(job.client_id, job_id, token):
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+        request.state.client = job.client_id
+        admission.admit(job.client_id)
+    return StreamingResponse(
+        stream_job_events(job),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they happen
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Batch endpoints: fan product variants out as jobs and stream NDJSON lines as each finishes
+@app.post("/api/batch/text2img", summary="Render one prompt for many products and sizes")
+async def batch_text2img(
+    request: BatchText2ImgRequest,
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
+):
+    try:
+        for size in request.sizes:
+            parse_size(size, None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    request.product_codes = resolve_product_codes(request.product_codes)
+
+    variants = [
+        GenerateRequest(prompt=request.prompt, size_choice=size, product_codes=[product_code])
+        for product_code in request.product_codes
+        for size in request.sizes
+    ]
+    check_batch_capacity(len(variants))
+    # Variants rendered before cost nothing, so only the others need quota
+    reserved = [await find_text2img(variant) is None for variant in variants]
+    if any(reserved):
+        admission.reserve(client_id, sum(reserved))
+    jobs = [
+        submit_job("text2img", {"request": variant, "client_id": client_id, "reserved": needs_quota})
+        for variant, needs_quota in zip(variants, reserved)
+    ]
+    return StreamingResponse(stream_batch(jobs), media_type="application/x-ndjson")
+
+@app.post("/api/batch/img2img", summary="Apply many products to one uploaded room image")
+async def batch_img2img(
+    image: UploadFile = File(...),
+    request: Img2ImgRequest = Depends(),
+    api_key: str = Depends(verify_api_key),
+    client_id: str = Depends(get_client_id)
+):
+    try:
+        parse_size(request.size_choice, request.custom_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    request.product_codes = resolve_product_codes(request.product_codes, need_texture=True)
+
+    check_batch_capacity(len(request.product_codes))
+    image_path = await save_upload(image)
+    variants = [request.model_copy(update={"product_codes": [product_code]}) for product_code in request.product_codes]
+    # Variants rendered before cost nothing, so only the others need quota and the upstream upload
+    image_digest = await asyncio.to_thread(file_sha256, image_path)
+    reserved = [await find_img2img(image_digest, variant) is None for variant in variants]
+    if any(reserved):
+        admission.check_quota(client_id, sum(reserved))
+
+    # The room image is uploaded once and shared by every variant
+    image_resource = None
+    if any(reserved):
+        endpoint = upstream_pool.choose()
+        try:
+            image_resource_id = await upload_image_to_tensorart(image_path, endpoint)
+            if not image_resource_id:
+                raise HTTPException(status_code=500, detail="Failed to upload input image.")
+            image_resource = upstream_pool.ref(endpoint, image_resource_id)
+        except UpstreamUnavailable:
+            # Each variant uploads it again on whichever endpoint it ends up on
+            pass
+
+    # Checked again after the uploads, so that every variant below is queued
+    check_batch_capacity(len(variants))
+    if any(reserved):
+        admission.reserve(client_id, sum(reserved))
+    jobs = [
+        submit_job("img2img", {
+            "request": variant,
+            "image_path": image_path,
+            "image_resource": image_resource,
+            "client_id": client_id,
+            "reserved": needs_quota,
+        })
+        for variant, needs_quota in zip(variants, reserved)
+    ]
+    return StreamingResponse(stream_batch(jobs), media_type="application/x-ndjson")
+
+def check_batch_capacity(variant_count: int):
+    if variant_count == 0:
+        raise HTTPException(status_code=400, detail="At least one variant is required")
+    if variant_count > BATCH_MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {BATCH_MAX_VARIANTS} variants")
+    upstream_scheduler.check_capacity()
+    if not job_manager.has_capacity(variant_count):
+        raise HTTPException(
+            status_code=429,
+            detail="Job queue is full, please retry later",
+            headers={"Retry-After": str(upstream_scheduler.retry_after())}
+        )
+
+def describe_batch_job(job: "Job") -> dict:
+    request = job.params["request"]
+    return {**job.to_dict(), "product_code": request.product_codes[0], "size": request.size_choice}
+
+async def stream_batch(jobs: List["Job"]):
+    yield json.dumps({"jobs": [{**describe_batch_job(job), **describe_new_job(job)} for job in jobs]}) + "\n"
+
+    waiters = {asyncio.create_task(job.done.wait()): job for job in jobs}
+    try:
+        while waiters:
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in done:
+                yield json.dumps(describe_batch_job(waiters.pop(waiter))) + "\n"
+    finally:
+        # The client went away: stop waiting, the jobs themselves keep running
+        for waiter in waiters:
+            waiter.cancel()
+
+def format_event(event: str, data: dict, event_id: int) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_job_events(job: "Job"):
+    """One "progress" event per stage change, then a final succeeded/failed/cancelled event.
+
+    Comments keep idle connections open; the stream ends after JOB_EVENTS_TIMEOUT and
+    EventSource reconnects on its own, picking up the job's current state.
+    """
+    yield f"retry: {int(JOB_REMOTE_POLL_INTERVAL * 2000)}\n\n"
+    deadline = time.time() + JOB_EVENTS_TIMEOUT
+    event_id = 0
+    sent = None
+    while True:
+        state = job.to_dict()
+        if state != sent:
+            event_id += 1
+            event = job.status if job.is_finished else "progress"
+            yield format_event(event, state, event_id)
+            sent = state
+        elif time.time() < deadline:
+            yield ": keepalive\n\n"
+        if job.is_finished or time.time() >= deadline:
+            return
+        job = await job_manager.watch(job, sent, min(JOB_EVENTS_KEEPALIVE, max(0, deadline - time.time())))
+
+@app.post("/api/preview/img2img", summary="Fast local preview of a product in an already rendered room",
+          response_class=FileResponse)
+async def preview_img2img(
+    image: UploadFile = File(...),
+    request: PreviewRequest = Depends(),
+    api_key: str = Depends(verify_api_key)
+):
+    if not request.product_codes:
+        raise HTTPException(status_code=400, detail="A product code is required")
+    request.product_codes = resolve_product_codes(request.product_codes, need_texture=True)
+    image_path = await save_upload(image)
+    preview_path = await get_preview(image_path, request.position, load_catalog().get(request.product_codes[0]))
+    if preview_path is None:
+        raise HTTPException(
+            status_code=404,
+            detail="This room has not been rendered for that position yet; run img2img on it once first"
+        )
+    return FileResponse(path=str(preview_path), media_type="image/jpeg", filename="preview.jpg")
+
+# Derived renditions (thumbnails, WebP/AVIF/progressive JPEG) of generated images
+@app.get("/api/images/{name}", summary="Download a generated image or a resized rendition", response_class=FileResponse)
+async def get_image(
+    name: str,
+    w: Optional[int] = Query(None, ge=1, le=4096, description="Maximum width, rounded up to a supported size"),
+    h: Optional[int] = Query(None, ge=1, le=4096, description="Maximum height, rounded up to a supported size"),
+    format: Optional[str] = Query(None, description="Output format: jpeg, png, webp or avif"),
+    quality: int = Query(80, ge=1, le=100, description="Encoder quality for lossy formats, rounded to a supported one")
+):
+    source_path = find_image(name)
+    if source_path is None:
+        raise HTTPException(status_code=404, detail=f"Image {name} not found")
+
+    if w is None and h is None and format is None:
+        return FileResponse(path=str(source_path), media_type=guess_image_media_type(source_path))
+
+    image_format = (format or source_path.suffix.lstrip(".")).lower()
+    image_format = "jpeg" if image_format == "jpg" else image_format
+    if image_format not in derivative_formats():
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {image_format}")
+
+    derivative_path = await get_derivative(source_path, snap_size(w), snap_size(h), image_format, snap_quality(quality))
+    return FileResponse(
+        path=str(derivative_path),
+        media_type=DERIVATIVE_MEDIA_TYPES[image_format],
+        headers={"Cache-Control": f"public, max-age={DERIVATIVE_MAX_AGE}"}
+    )
+
 # Helper functions (unchanged)
 def parse_size(size_choice: str, custom_size: Optional[str]) -> tuple:
     try:
@@ -202,17 +726,715 @@ def rewrite_prompt_with_groq(vietnamese_prompt: str, product_codes: List[str]) -
     prompt = f"{vietnamese_prompt}, featuring {' and '.join(product_codes)} quartz marble"
     return prompt
 
-@lru_cache(maxsize=10)
-def load_product_image_map():
-    return PRODUCT_IMAGE_MAP
+# Product catalog: read once from a manifest, indexed by full name ("C1012 Glacier White")
+# and short code ("C1012"). File sizes, hashes and dimensions are precomputed in the
+# manifest; startup only stats the files and re-reads the ones that changed.
+PRODUCT_CATALOG_PATH = Path(os.getenv("PRODUCT_CATALOG_PATH", str(BASE_DIR / "product_images" / "manifest.json")))
+
+@dataclass
+class Product:
+    code: str
+    name: str
+    image: Path
+    bytes: Optional[int] = None
+    sha256: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.code} {self.name}"
+
+    @property
+    def available(self) -> bool:
+        """Whether the texture image exists, i.e. the product can be used for img2img."""
+        return self.bytes is not None
+
+    def describe(self) -> dict:
+        return {
+            "code": self.code,
+            "name": self.full_name,
+            "available": self.available,
+            "width": self.width,
+            "height": self.height,
+            "sha256": self.sha256,
+        }
+
+    def to_manifest(self) -> dict:
+        return {
+            "code": self.code, "name": self.name, "image": self.image.name,
+            "bytes": self.bytes, "sha256": self.sha256, "width": self.width, "height": self.height,
+        }
+
+def read_image_metadata(path: Path) -> dict:
+    with Image.open(path) as img:
+        width, height = img.size
+    return {"bytes": path.stat().st_size, "sha256": file_sha256(str(path)), "width": width, "height": height}
+
+class ProductCatalog:
+    def __init__(self, manifest_path: Path, products: List[Product]):
+        self.manifest_path = manifest_path
+        self.products = products
+        self.by_name: Dict[str, Product] = {product.full_name.lower(): product for product in products}
+        self.by_code: Dict[str, Product] = {product.code.upper(): product for product in products}
+        self.problems: List[str] = []
+
+    @classmethod
+    def load(cls, manifest_path: Path) -> "ProductCatalog":
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                entries = json.load(f)["products"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not read the product catalog {manifest_path}: {str(e)}")
+            entries = []
+        products = [
+            Product(
+                code=entry["code"], name=entry["name"], image=manifest_path.parent / entry["image"],
+                bytes=entry.get("bytes"), sha256=entry.get("sha256"),
+                width=entry.get("width"), height=entry.get("height")
+            )
+            for entry in entries
+        ]
+        catalog = cls(manifest_path, products)
+        catalog.validate()
+        return catalog
+
+    def validate(self, refresh: bool = False):
+        """Check every texture against the manifest; missing files make a product text-only."""
+        self.problems = []
+        for product in self.products:
+            try:
+                size = product.image.stat().st_size
+            except OSError:
+                product.bytes = product.sha256 = product.width = product.height = None
+                self.problems.append(f"{product.full_name}: texture {product.image.name} is missing")
+                continue
+            if refresh or size != product.bytes or product.width is None:
+                if not refresh:
+                    self.problems.append(f"{product.full_name}: manifest entry is stale")
+                try:
+                    metadata = read_image_metadata(product.image)
+                except OSError as e:
+                    product.bytes = None
+                    self.problems.append(f"{product.full_name}: texture is unreadable ({str(e)})")
+                    continue
+                for attribute, value in metadata.items():
+                    setattr(product, attribute, value)
+
+    def get(self, code_or_name: str) -> Optional[Product]:
+        """Look a product up by full name, or by the short code its name starts with."""
+        key = code_or_name.strip()
+        product = self.by_name.get(key.lower())
+        if product is None and key:
+            product = self.by_code.get(key.split()[0].upper())
+        return product
+
+    def available(self) -> List[Product]:
+        return [product for product in self.products if product.available]
+
+    def write(self):
+        manifest = {"products": [product.to_manifest() for product in self.products]}
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+@lru_cache(maxsize=1)
+def load_catalog() -> ProductCatalog:
+    return ProductCatalog.load(PRODUCT_CATALOG_PATH)
+
+def resolve_product_codes(product_codes: List[str], need_texture: bool = False) -> List[str]:
+    """Canonical full names for product_codes, so "C1012" and "C1012 Glacier White" share caches.
+
+    text2img only puts products into the prompt, so unknown ones pass through unchanged;
+    img2img needs each product's texture and rejects anything it cannot render.
+    """
+    catalog = load_catalog()
+    names = []
+    for code in product_codes:
+        product = catalog.get(code)
+        if product is None:
+            if need_texture:
+                raise HTTPException(status_code=400, detail=f"Unknown product code {code}")
+            names.append(code)
+        elif need_texture and not product.available:
+            raise HTTPException(status_code=400, detail=f"No texture image for product {product.full_name}")
+        else:
+            names.append(product.full_name)
+    return names
+
+# txt2img generation parameters; also part of the result cache key
+TXT2IMG_MODEL_ID = "779398605850080514"
+TXT2IMG_VAE_ID = "ae.sft"
+TXT2IMG_SAMPLER_PARAMS = {
+    "sampler": "Euler a",
+    "steps": 30,
+    "cfgScale": 8,
+    "clipSkip": 1,
+    "etaNoiseSeedDelta": 31337,
+}
+
+# Shared, pooled HTTP client for every TensorArt call
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_MAX_PER_HOST = int(os.getenv("UPSTREAM_MAX_PER_HOST", "20"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.5"))
+
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(256 * 1024)))
+
+# POSTs create paid jobs, so they are only retried when the upstream cannot have acted on them.
+# A 502 or 504 from a gateway often means the origin did accept the request, so only 503 counts.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRYABLE_POST_STATUSES = {503}
+
+async def iter_file_chunks(path: str) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as f:
+        while True:
+            chunk = await f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+class UpstreamClient:
+    """One keep-alive connection pool with per-host limits and jittered retries."""
+
+    def __init__(self, timeout: float, connect_timeout: float, max_connections: int,
+                 max_keepalive: int, max_per_host: int, max_retries: int, retry_backoff: float):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "in_flight": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _should_retry(self, method: str, attempt: int, response: Optional[httpx.Response] = None,
+                      error: Optional[Exception] = None) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if method in IDEMPOTENT_METHODS:
+            return error is not None or response.status_code >= 500
+        if error is not None:
+            return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        return response.status_code in RETRYABLE_POST_STATUSES
+
+    async def request(self, method: str, url: str,
+                      content_factory: Optional[Callable[[], AsyncIterator[bytes]]] = None,
+                      **kwargs) -> httpx.Response:
+        method = method.upper()
+        host = httpx.URL(url).host
+        slots = self._host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        attempt = 0
+        while True:
+            self.stats["requests"] += 1
+            if content_factory is not None:
+                # Streamed bodies are consumed by each attempt, so build a fresh one per try
+                kwargs["content"] = content_factory()
+            try:
+                async with slots:
+                    self.stats["in_flight"] += 1
+                    try:
+                        response = await self.client.request(method, url, **kwargs)
+                    finally:
+                        self.stats["in_flight"] -= 1
+                UPSTREAM_RESPONSES.inc(method, str(response.status_code))
+            except httpx.TransportError as e:
+                UPSTREAM_RESPONSES.inc(method, type(e).__name__)
+                self.stats["errors"] += 1
+                if not self._should_retry(method, attempt, error=e):
+                    raise
+                logger.warning(f"{method} {host} failed ({type(e).__name__}), retrying")
+            else:
+                if response.status_code < 500:
+                    return response
+                self.stats["errors"] += 1
+                if not self._should_retry(method, attempt, response=response):
+                    return response
+                logger.warning(f"{method} {host} returned {response.status_code}, retrying")
+
+            self.stats["retries"] += 1
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("PUT", url, **kwargs)
+
+    async def download(self, url: str, dest_path: Path) -> str:
+        """Stream a response body to dest_path in chunks and return its Content-Type."""
+        host = httpx.URL(url).host
+        slots = self._host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        part_path = dest_path.with_name(dest_path.name + ".part")
+        attempt = 0
+        while True:
+            self.stats["requests"] += 1
+            try:
+                async with slots:
+                    self.stats["in_flight"] += 1
+                    try:
+                        async with self.client.stream("GET", url) as response:
+                            UPSTREAM_RESPONSES.inc("GET", str(response.status_code))
+                            response.raise_for_status()
+                            async with aiofiles.open(part_path, "wb") as f:
+                                async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                                    await f.write(chunk)
+                            os.replace(part_path, dest_path)
+                            return response.headers.get("content-type", "")
+                    finally:
+                        self.stats["in_flight"] -= 1
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if isinstance(e, httpx.TransportError):
+                    UPSTREAM_RESPONSES.inc("GET", type(e).__name__)
+                self.stats["errors"] += 1
+                retryable = isinstance(e, httpx.TransportError) or e.response.status_code >= 500
+                if not retryable or not self._should_retry("GET", attempt, error=e):
+                    part_path.unlink(missing_ok=True)
+                    raise
+                logger.warning(f"Download from {host} failed ({str(e)}), retrying")
+
+            self.stats["retries"] += 1
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    async def put_file(self, url: str, path: str, headers: dict) -> httpx.Response:
+        """PUT a local file as a chunked stream with an explicit Content-Length."""
+        headers = {**headers, "Content-Length": str(os.path.getsize(path))}
+        return await self.request("PUT", url, content_factory=lambda: iter_file_chunks(path), headers=headers)
+
+    def pool_stats(self) -> dict:
+        connections = []
+        if self._client is not None:
+            # httpx does not expose pool state publicly; read it defensively from the transport
+            pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {
+            **self.stats,
+            "connections": len(connections),
+            "idle_connections": idle,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "max_per_host": self.max_per_host,
+            "hosts": {host: self.max_per_host - slots._value for host, slots in self._host_slots.items()},
+        }
+
+upstream_client = UpstreamClient(
+    UPSTREAM_TIMEOUT, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE, UPSTREAM_MAX_PER_HOST, UPSTREAM_MAX_RETRIES, UPSTREAM_RETRY_BACKOFF
+)
+
+# Upstream pool: URL_PRE and API_KEY_TOKEN may list several base URLs and keys. Each
+# pairing is an endpoint; new work goes to the healthy endpoint with the lowest observed
+# latency and moves on to the next one when an endpoint turns it away.
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_FAILURE_THRESHOLD", "3"))
+UPSTREAM_COOLDOWN = float(os.getenv("UPSTREAM_COOLDOWN", "30"))
+UPSTREAM_LATENCY_DECAY = float(os.getenv("UPSTREAM_LATENCY_DECAY", "0.2"))
+# Hedging starts a second txt2img job elsewhere when the first is still queued after
+# UPSTREAM_HEDGE_AFTER seconds (0 disables it); at most UPSTREAM_HEDGE_BUDGET extra jobs per job
+UPSTREAM_HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER", "0"))
+UPSTREAM_HEDGE_BUDGET = float(os.getenv("UPSTREAM_HEDGE_BUDGET", "0.1"))
+# Latency and queue time fade by half every UPSTREAM_SCORE_HALF_LIFE seconds without a new
+# sample, so an endpoint that looked slow once gets tried again instead of starving (0 = never)
+UPSTREAM_SCORE_HALF_LIFE = float(os.getenv("UPSTREAM_SCORE_HALF_LIFE", "30"))
+
+UPSTREAM_FAILOVERS = metrics.register(Counter(
+    "casla_upstream_failovers_total", "Work moved off an endpoint that turned it away", ("endpoint", "reason")
+))
+UPSTREAM_HEDGES = metrics.register(Counter(
+    "casla_upstream_hedges_total", "Hedged txt2img jobs by which job finished first", ("winner",)
+))
+UPSTREAM_ENDPOINT_LATENCY = metrics.register(Histogram(
+    "casla_upstream_endpoint_latency_seconds", "TensorArt API call latency per endpoint", ("endpoint",),
+    LATENCY_BUCKETS
+))
+
+class UpstreamUnavailable(RuntimeError):
+    """An endpoint turned the work away, so it may be retried on another one."""
+
+# Answers that prove a POST was turned away before it created a job. Any other 5xx may
+# come after the job was created, so new jobs and workflows only fail over on these.
+REFUSED_STATUSES = {429, 503}
+
+def is_unavailable(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+def is_refused(response: httpx.Response) -> bool:
+    return response.status_code in REFUSED_STATUSES
+
+def faded(value: float, sampled_at: float) -> float:
+    if UPSTREAM_SCORE_HALF_LIFE <= 0:
+        return value
+    return value * 0.5 ** ((time.time() - sampled_at) / UPSTREAM_SCORE_HALF_LIFE)
+
+def split_list(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+@dataclass
+class UpstreamEndpoint:
+    name: str
+    base_url: str
+    api_key: str = field(repr=False)
+    latency: float = 0.0
+    latency_at: float = 0.0
+    queue_time: float = 0.0
+    queue_time_at: float = 0.0
+    active: int = 0
+    failures: int = 0
+    cooldown_until: float = 0.0
+    requests: int = 0
+    errors: int = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.time() >= self.cooldown_until
+
+    @property
+    def score(self) -> float:
+        # Decayed API latency plus time spent queued upstream, scaled by the work already sent here
+        return (faded(self.latency, self.latency_at) + faded(self.queue_time, self.queue_time_at)) * (1 + self.active)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def headers(self) -> dict:
+        return {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {self.api_key}'
+        }
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "latency": round(faded(self.latency, self.latency_at), 4),
+            "queue_time": round(faded(self.queue_time, self.queue_time_at), 3),
+            "active": self.active,
+            "failures": self.failures,
+            "cooldown_remaining": round(max(0.0, self.cooldown_until - time.time()), 1),
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+class UpstreamPool:
+    """TensorArt endpoints with health tracking, latency-aware routing and failover.
+
+    Upstream IDs are handed out as references of the form "<endpoint>/<id>" so that status
+    checks, resumes and workflow inputs go back to the endpoint that owns them. Resources
+    uploaded through one API key are not visible to another, so work is only moved to a
+    different endpoint before anything has been submitted for it.
+    """
+
+    def __init__(self, endpoints: List[UpstreamEndpoint], client: UpstreamClient, failure_threshold: int,
+                 cooldown: float, decay: float, hedge_after: float, hedge_budget: float):
+        self.endpoints = endpoints
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.decay = decay
+        self.hedge_after = hedge_after
+        self.hedge_budget = hedge_budget
+        self.stats = {"submissions": 0, "failovers": 0, "ambiguous": 0, "hedges": 0, "hedge_wins": 0}
+        # Submitted but not yet running upstream: ref -> (submitted_at, started event)
+        self._pending: Dict[str, tuple] = {}
+
+    def require(self):
+        if not self.endpoints:
+            raise ValueError("API_KEY_TOKEN and URL_PRE environment variables must be set")
+
+    def get(self, name: str) -> Optional[UpstreamEndpoint]:
+        return next((endpoint for endpoint in self.endpoints if endpoint.name == name), None)
+
+    def choose(self, exclude: set = frozenset()) -> Optional[UpstreamEndpoint]:
+        self.require()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.name not in exclude]
+        if not candidates:
+            return None
+        healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+        if not healthy:
+            # Everything is cooling down; the one that recovers first is the best bet
+            return min(candidates, key=lambda endpoint: endpoint.cooldown_until)
+        return min(healthy, key=lambda endpoint: endpoint.score)
+
+    def ref(self, endpoint: UpstreamEndpoint, upstream_id: str) -> str:
+        return f"{endpoint.name}/{upstream_id}"
+
+    def resolve(self, ref: str) -> tuple:
+        """Split a reference into its endpoint and the endpoint's own ID."""
+        self.require()
+        name, _, upstream_id = str(ref).rpartition("/")
+        if not name:
+            # Journal entries written before the pool existed came from the first endpoint
+            return self.endpoints[0], upstream_id
+        endpoint = self.get(name)
+        if endpoint is None:
+            raise RuntimeError(f"Upstream endpoint {name} is no longer configured")
+        return endpoint, upstream_id
+
+    async def request(self, endpoint: UpstreamEndpoint, method: str, path: str, **kwargs) -> httpx.Response:
+        endpoint.requests += 1
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, endpoint.url(path), headers=endpoint.headers(), **kwargs)
+        except httpx.TransportError:
+            self._failed(endpoint)
+            raise
+        elapsed = time.perf_counter() - started
+        UPSTREAM_ENDPOINT_LATENCY.observe(elapsed, endpoint.name)
+        if response.status_code == 429:
+            self._failed(endpoint, cooldown=self._retry_after(response))
+        elif response.status_code >= 500:
+            self._failed(endpoint)
+        else:
+            endpoint.failures = 0
+            endpoint.latency = self._decayed(faded(endpoint.latency, endpoint.latency_at), elapsed)
+            endpoint.latency_at = time.time()
+        return response
+
+    async def submit(self, path: str, exclude: set = frozenset(), **kwargs) -> tuple:
+        """POST new work to the best endpoint, failing over on 429/503 and connection errors.
+
+        Returns (endpoint, response); the last endpoint's response is returned as-is, and so
+        is any other error, which may have created the job and must not be resubmitted.
+        """
+        tried = set(exclude)
+        while True:
+            endpoint = self.choose(exclude=tried)
+            if endpoint is None:
+                raise UpstreamUnavailable("No other upstream endpoint is available")
+            tried.add(endpoint.name)
+            last = len(tried) >= len(self.endpoints)
+            self.stats["submissions"] += 1
+            try:
+                response = await self.request(endpoint, "POST", path, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Only errors that prove the request never arrived; anything else may have created a job
+                if last:
+                    raise
+                reason = type(e).__name__
+            except httpx.TransportError as e:
+                self.ambiguous(endpoint, path, type(e).__name__)
+                raise
+            else:
+                if response.status_code >= 500 and not is_refused(response):
+                    self.ambiguous(endpoint, path, str(response.status_code))
+                if last or not is_refused(response):
+                    return endpoint, response
+                reason = str(response.status_code)
+            self.stats["failovers"] += 1
+            UPSTREAM_FAILOVERS.inc(endpoint.name, reason)
+            logger.warning(f"Upstream endpoint {endpoint.name} answered {reason} for {path}, failing over")
+
+    def ambiguous(self, endpoint: UpstreamEndpoint, path: str, reason: str):
+        self.stats["ambiguous"] += 1
+        logger.warning(f"POST {path} to upstream endpoint {endpoint.name} ended with {reason}; "
+                       f"it may have created the work anyway, so it is not resubmitted")
+
+    def submitted(self, ref: str):
+        self._pending[ref] = (time.time(), asyncio.Event())
+
+    def started(self, ref: str) -> Optional[asyncio.Event]:
+        """Event set once the job leaves the upstream queue; None if it is not being tracked."""
+        pending = self._pending.get(ref)
+        return pending[1] if pending else None
+
+    def running(self, ref: str):
+        """Called on every status check that shows the job has left the upstream queue."""
+        if self._record_queue_time(ref):
+            # Hedging waits on this
+            self._pending.pop(ref)[1].set()
+
+    def forget(self, ref: str):
+        # A job abandoned while still queued was queued at least this long
+        if self._record_queue_time(ref):
+            self._pending.pop(ref)
 
-def txt2img(prompt: str, width: int, height: int, product_codes: List[str]) -> Image.Image:
-    if not API_KEY_TOKEN or not URL_PRE:
-        raise ValueError("API_KEY_TOKEN and URL_PRE environment variables must be set")
+    def _record_queue_time(self, ref: str) -> bool:
+        pending = self._pending.get(ref)
+        if pending is None:
+            return False
+        endpoint, _ = self.resolve(ref)
+        endpoint.queue_time = self._decayed(faded(endpoint.queue_time, endpoint.queue_time_at), time.time() - pending[0])
+        endpoint.queue_time_at = time.time()
+        return True
+
+    @contextmanager
+    def busy(self, endpoint: UpstreamEndpoint):
+        endpoint.active += 1
+        try:
+            yield
+        finally:
+            endpoint.active -= 1
+
+    def allow_hedge(self) -> bool:
+        if self.hedge_after <= 0 or len(self.endpoints) < 2:
+            return False
+        return self.stats["hedges"] < self.hedge_budget * self.stats["submissions"]
+
+    def describe(self) -> dict:
+        return {
+            **self.stats,
+            "hedge_after": self.hedge_after,
+            "hedge_budget": self.hedge_budget,
+            "endpoints": [endpoint.describe() for endpoint in self.endpoints],
+        }
+
+    def _decayed(self, average: float, sample: float) -> float:
+        return sample if average == 0 else self.decay * sample + (1 - self.decay) * average
+
+    def _retry_after(self, response: httpx.Response) -> float:
+        try:
+            return max(float(response.headers.get("retry-after", "")), 1.0)
+        except ValueError:
+            return self.cooldown
+
+    def _failed(self, endpoint: UpstreamEndpoint, cooldown: Optional[float] = None):
+        endpoint.errors += 1
+        endpoint.failures += 1
+        if cooldown is None and endpoint.failures < self.failure_threshold:
+            return
+        endpoint.cooldown_until = time.time() + (cooldown if cooldown is not None else self.cooldown)
+        logger.warning(f"Upstream endpoint {endpoint.name} cooling down for "
+                       f"{endpoint.cooldown_until - time.time():.0f}s after {endpoint.failures} failures")
+
+def create_upstream_endpoints() -> List[UpstreamEndpoint]:
+    urls = [url.rstrip("/") for url in split_list(URL_PRE)]
+    keys = split_list(API_KEY_TOKEN)
+    if len(urls) > 1 and len(keys) > 1:
+        # Lists of both pair up positionally: one key per regional base URL
+        if len(urls) != len(keys):
+            logger.error(f"URL_PRE lists {len(urls)} URLs but API_KEY_TOKEN lists {len(keys)} keys; "
+                         f"using the first {min(len(urls), len(keys))} pairs")
+        pairs = list(zip(urls, keys))
+    else:
+        pairs = [(url, key) for url in urls for key in keys]
+    # Names must stay stable across restarts because journaled upstream IDs refer to them
+    return [
+        UpstreamEndpoint(hashlib.sha256(f"{url}|{key}".encode()).hexdigest()[:8], url, key)
+        for url, key in pairs
+    ]
+
+upstream_pool = UpstreamPool(
+    create_upstream_endpoints(), upstream_client, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_COOLDOWN,
+    UPSTREAM_LATENCY_DECAY, UPSTREAM_HEDGE_AFTER, UPSTREAM_HEDGE_BUDGET
+)
+
+# Completion strategies: how we learn that an upstream job or workflow has finished
+POLL_INITIAL_INTERVAL = float(os.getenv("POLL_INITIAL_INTERVAL", "1"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "8"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+UPSTREAM_JOB_TIMEOUT = float(os.getenv("UPSTREAM_JOB_TIMEOUT", "300"))
+COMPLETION_STRATEGY = os.getenv("COMPLETION_STRATEGY", "poll")
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_FALLBACK_INTERVAL = float(os.getenv("WEBHOOK_FALLBACK_INTERVAL", "15"))
+
+class PollingCompletion:
+    """Checks upstream status with exponential backoff (e.g. 1s, 2s, 4s, ... capped)."""
+
+    name = "poll"
+    notify_url = ""
+
+    def __init__(self, initial_interval: float, max_interval: float, backoff: float, timeout: float):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+
+    async def wait(self, upstream_id: str, check: Callable[[], Awaitable[Optional[dict]]]) -> dict:
+        start_time = time.time()
+        interval = self.initial_interval
+        while True:
+            await self._sleep(upstream_id, interval)
+            if time.time() - start_time > self.timeout:
+                UPSTREAM_TIMEOUTS.inc(self.name)
+                raise TimeoutError(f"{upstream_id} timed out after {self.timeout} seconds")
+            POLL_ITERATIONS.inc(self.name)
+            result = await check()
+            if result is not None:
+                return result
+            interval = min(interval * self.backoff, self.max_interval)
+
+    async def _sleep(self, upstream_id: str, interval: float):
+        await asyncio.sleep(interval)
+
+class WebhookCompletion(PollingCompletion):
+    """Waits for TensorArt's runningNotifyUrl callback, polling slowly as a safety net."""
+
+    name = "webhook"
+
+    def __init__(self, base_url: str, secret: str, fallback_interval: float, timeout: float):
+        super().__init__(fallback_interval, fallback_interval, 1, timeout)
+        query = f"?token={secret}" if secret else ""
+        self.notify_url = f"{base_url.rstrip('/')}/api/tensorart/callback{query}"
+        self._events: Dict[str, asyncio.Event] = {}
+
+    async def wait(self, upstream_id: str, check: Callable[[], Awaitable[Optional[dict]]]) -> dict:
+        self._events.setdefault(upstream_id, asyncio.Event())
+        try:
+            return await super().wait(upstream_id, check)
+        finally:
+            self._events.pop(upstream_id, None)
+
+    async def _sleep(self, upstream_id: str, interval: float):
+        event = self._events[upstream_id]
+        try:
+            await asyncio.wait_for(event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def notify(self, upstream_id: str) -> bool:
+        event = self._events.get(upstream_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+polling_completion = PollingCompletion(POLL_INITIAL_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF, UPSTREAM_JOB_TIMEOUT)
+
+def create_workflow_completion():
+    if COMPLETION_STRATEGY == "webhook":
+        if PUBLIC_BASE_URL:
+            return WebhookCompletion(PUBLIC_BASE_URL, WEBHOOK_SECRET, WEBHOOK_FALLBACK_INTERVAL, UPSTREAM_JOB_TIMEOUT)
+        logger.warning("COMPLETION_STRATEGY=webhook requires PUBLIC_BASE_URL; falling back to polling")
+    return polling_completion
+
+workflow_completion = create_workflow_completion()
+
+UPSTREAM_QUEUED_STATUSES = {"CREATED", "PENDING", "QUEUED", "WAITING"}
+
+def report_upstream_status(ref: str, status: str):
+    if str(status).upper() in UPSTREAM_QUEUED_STATUSES:
+        report_progress("queued_upstream", upstream_status=status)
+        return
+    upstream_pool.running(ref)
+    report_progress("running", upstream_status=status)
+
+async def txt2img(prompt: str, width: int, height: int, product_codes: List[str], save_path: Path,
+                  on_submit: Optional[Callable[[str], Awaitable]] = None) -> str:
+    upstream_pool.require()
     
-    model_id = "779398605850080514"
-    vae_id = "ae.sft"
-    request_id = hashlib.md5(str(int(time.time())).encode()).hexdigest()
+    request_id = uuid.uuid4().hex
     
     logger.info(f"Starting txt2img job with request_id: {request_id}")
 
@@ -227,90 +1449,162 @@ def txt2img(prompt: str, width: int, height: int, product_codes: List[str]) -> I
                     "height": height,
                     "prompts": [{"text": prompt}],
                     "negativePrompts": [{"text": " "}],
-                    "sdModel": model_id,
-                    "sdVae": vae_id,
-                    "sampler": "Euler a",
-                    "steps": 30,
-                    "cfgScale": 8,
-                    "clipSkip": 1,
-                    "etaNoiseSeedDelta": 31337,
+                    "sdModel": TXT2IMG_MODEL_ID,
+                    "sdVae": TXT2IMG_VAE_ID,
+                    **TXT2IMG_SAMPLER_PARAMS,
                 }
             }
         ]
     }
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {API_KEY_TOKEN}'
-    }
-    
+    report_progress("submitting")
+    job_ref = await submit_txt2img(txt2img_data)
+    if on_submit is not None:
+        await on_submit(job_ref)
+    if not upstream_pool.allow_hedge():
+        return await finish_txt2img(job_ref, save_path)
+    return await hedge_txt2img(job_ref, txt2img_data, save_path)
+
+async def submit_txt2img(txt2img_data: dict, exclude: set = frozenset()) -> str:
+    """Create a txt2img job and return its upstream reference."""
     try:
-        response = requests.post(f"{URL_PRE}/jobs", json=txt2img_data, headers=headers)
-        response.raise_for_status()
+        with observe_stage("txt2img_submit"):
+            endpoint, response = await upstream_pool.submit("/jobs", exclude=exclude, json=txt2img_data)
+            response.raise_for_status()
         
         response_data = response.json()
         job_id = response_data['job']['id']
-        logger.info(f"Job created. ID: {job_id}")
-        
-        start_time = time.time()
-        timeout = 300
+        logger.info(f"Job created on {endpoint.name}. ID: {job_id}")
         
-        while True:
-            time.sleep(10)
-            elapsed_time = time.time() - start_time
-            
-            if elapsed_time > timeout:
-                raise TimeoutError(f"Job timed out after {timeout} seconds")
-                
-            response = requests.get(f"{URL_PRE}/jobs/{job_id}", headers=headers)
+    except httpx.HTTPError as e:
+        logger.error(f"Request error: {str(e)}")
+        raise RuntimeError(f"API request failed: {str(e)}")
+
+    job_ref = upstream_pool.ref(endpoint, job_id)
+    upstream_pool.submitted(job_ref)
+    return job_ref
+
+async def hedge_txt2img(job_ref: str, txt2img_data: dict, save_path: Path) -> str:
+    """Race the job against a copy on another endpoint if it is still queued after UPSTREAM_HEDGE_AFTER.
+
+    Whichever finishes first wins; the other is abandoned (TensorArt still bills it, which
+    UPSTREAM_HEDGE_BUDGET caps).
+    """
+    primary = asyncio.create_task(finish_txt2img(job_ref, save_path))
+    hedge: Optional[asyncio.Task] = None
+    hedge_path = save_path.with_name(f"{save_path.stem}.hedge{save_path.suffix}")
+    try:
+        started = upstream_pool.started(job_ref)
+        if started is not None:
+            started_wait = asyncio.create_task(started.wait())
+            await asyncio.wait({primary, started_wait}, timeout=upstream_pool.hedge_after,
+                               return_when=asyncio.FIRST_COMPLETED)
+            started_wait.cancel()
+        if primary.done() or started is None or started.is_set() or not upstream_pool.allow_hedge():
+            return await primary
+
+        primary_endpoint, _ = upstream_pool.resolve(job_ref)
+        try:
+            hedge_ref = await submit_txt2img(txt2img_data, exclude={primary_endpoint.name})
+        except (RuntimeError, httpx.HTTPError) as e:
+            logger.warning(f"Could not hedge {job_ref}: {str(e)}")
+            return await primary
+        upstream_pool.stats["hedges"] += 1
+        logger.info(f"{job_ref} still queued after {upstream_pool.hedge_after}s, hedging with {hedge_ref}")
+        hedge = asyncio.create_task(finish_txt2img(hedge_ref, hedge_path))
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    continue
+                if task is hedge:
+                    os.replace(hedge_path, save_path)
+                    upstream_pool.stats["hedge_wins"] += 1
+                UPSTREAM_HEDGES.inc("hedge" if task is hedge else "primary")
+                return str(save_path)
+        # Both failed; report the original job's error
+        return primary.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+        hedge_path.unlink(missing_ok=True)
+        hedge_path.with_name(hedge_path.name + ".part").unlink(missing_ok=True)
+
+async def finish_txt2img(job_ref: str, save_path: Path) -> str:
+    """Wait for a submitted txt2img job and download its image to save_path."""
+    endpoint, job_id = upstream_pool.resolve(job_ref)
+
+    try:
+        async def check_job() -> Optional[dict]:
+            response = await upstream_pool.request(endpoint, "GET", f"/jobs/{job_id}")
             response.raise_for_status()
             
             job_data = response.json()
             job_status = job_data['job']['status']
+            report_upstream_status(job_ref, job_status)
             
             if job_status == 'SUCCESS':
-                image_url = job_data['job']['successInfo']['images'][0]['url']
-                logger.info(f"Job completed successfully. Image URL: {image_url}")
-                
-                response_image = requests.get(image_url)
-                response_image.raise_for_status()
-                
-                img = Image.open(BytesIO(response_image.content))
-                save_path = Path(SAVE_DIR) / f"{hashlib.md5(prompt.encode()).hexdigest()}.png"
-                img.save(save_path)
-                
-                logger.info(f"Image saved to: {save_path}")
-                return img
-                
+                return job_data
             elif job_status == 'FAILED':
                 error_info = job_data['job'].get('failureInfo', {}).get('message', 'Unknown error')
                 raise RuntimeError(f"Job failed: {error_info}")
-                
-    except requests.RequestException as e:
+            return None
+        
+        with observe_stage("txt2img_poll"), upstream_pool.busy(endpoint):
+            job_data = await polling_completion.wait(job_ref, check_job)
+        
+        image_url = job_data['job']['successInfo']['images'][0]['url']
+        logger.info(f"Job completed successfully. Image URL: {image_url}")
+        
+        report_progress("downloading")
+        with observe_stage("txt2img_download"):
+            await upstream_client.download(image_url, save_path)
+        if not await asyncio.to_thread(is_png, save_path):
+            # Only decode when TensorArt hands back something other than the PNG we serve
+            with observe_stage("convert"):
+                await asyncio.to_thread(convert_to_png, save_path)
+        
+        logger.info(f"Image saved to: {save_path}")
+        return str(save_path)
+            
+    except httpx.HTTPError as e:
         logger.error(f"Request error: {str(e)}")
         raise RuntimeError(f"API request failed: {str(e)}")
+    finally:
+        upstream_pool.forget(job_ref)
 
-def upload_image_to_tensorart(image_path: str) -> str:
-    if not API_KEY_TOKEN or not URL_PRE:
-        raise ValueError("API_KEY_TOKEN and URL_PRE environment variables must be set")
-        
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def is_png(path: Path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE
+
+def convert_to_png(path: Path):
+    # Pillow work is CPU-bound, so callers run this in a worker thread
+    tmp_path = path.with_name(path.name + ".tmp")
+    with Image.open(path) as img:
+        img.save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+
+@timed_stage("upload_image_to_tensorart")
+async def upload_image_to_tensorart(image_path: str, endpoint: UpstreamEndpoint) -> str:
+    """Upload an image as a resource of endpoint; the resource ID only works on that endpoint."""
     try:
-        url = f"{URL_PRE}/resource/image"
-        payload = json.dumps({"expireSec": "7200"})
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {API_KEY_TOKEN}'
-        }
-        
-        logger.info(f"Starting upload for: {image_path}")
+        payload = json.dumps({"expireSec": str(RESOURCE_EXPIRE_SEC)})
+
+        logger.info(f"Starting upload for: {image_path} to {endpoint.name}")
+        report_progress("uploading")
         
         if not os.path.exists(image_path):
             logger.error(f"File does not exist: {image_path}")
             return None
             
-        response = requests.post(url, headers=headers, data=payload, timeout=30)
+        response = await upstream_pool.request(endpoint, "POST", "/resource/image", content=payload, timeout=30)
+        if is_unavailable(response):
+            raise UpstreamUnavailable(f"{endpoint.name} answered {response.status_code} to a resource upload")
         response.raise_for_status()
         
         resource_response = response.json()
@@ -324,14 +1618,13 @@ def upload_image_to_tensorart(image_path: str) -> str:
         
         logger.info(f"Got putUrl: {put_url}")
         
-        with open(image_path, 'rb') as img_file:
-            upload_response = requests.put(put_url, data=img_file, headers=headers_put)
+        upload_response = await upstream_client.put_file(put_url, image_path, headers_put)
+        
+        if upload_response.status_code not in [200, 203]:
+            raise Exception(f"PUT failed with status {upload_response.status_code}: {upload_response.text}")
             
-            if upload_response.status_code not in [200, 203]:
-                raise Exception(f"PUT failed with status {upload_response.status_code}: {upload_response.text}")
-                
-            if upload_response.status_code == 203:
-                logger.warning("Warning: PUT returned 203 - CallbackFailed, but proceeding with resourceId")
+        if upload_response.status_code == 203:
+            logger.warning("Warning: PUT returned 203 - CallbackFailed, but proceeding with resourceId")
         
         resource_id = resource_response.get('resourceId')
         
@@ -341,46 +1634,46 @@ def upload_image_to_tensorart(image_path: str) -> str:
             
         logger.info(f"Upload successful - resourceId: {resource_id}")
         
-        time.sleep(10)
-        logger.info(f"Waited 10s for resource sync: {resource_id}")
+        # TensorArt has no resource status endpoint, so give the upload a short grace period to sync
+        if RESOURCE_SYNC_DELAY > 0:
+            await asyncio.sleep(RESOURCE_SYNC_DELAY)
+            logger.info(f"Waited {RESOURCE_SYNC_DELAY}s for resource sync: {resource_id}")
         
         return resource_id
         
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Upload error for {image_path}: {str(e)}")
         return None
 
-def generate_mask(image_resource_id: str, position: str, selected_product_code: str) -> str:
+@timed_stage("generate_mask")
+async def generate_mask(image_resource_id: str, position: str, selected_product_code: str,
+                        endpoint: UpstreamEndpoint, image_size: Optional[tuple] = None,
+                        on_submit: Optional[Callable[[str], Awaitable]] = None) -> str:
     try:
         if not image_resource_id:
             raise ValueError("Invalid image_resource_id - original image not uploaded")
             
         logger.info(f"Using image_resource_id: {image_resource_id}")
         
-        time.sleep(10)
-        
-        product_image_map = load_product_image_map()
-        short_code = selected_product_code.split()[0]
-        texture_filepath = product_image_map.get(selected_product_code)
+        product = load_catalog().get(selected_product_code)
+        if product is None or not product.available:
+            raise ValueError(f"Texture image not found for product code {selected_product_code}")
         
-        logger.info(f"Texture file: {texture_filepath}, exists: {os.path.exists(texture_filepath) if texture_filepath else False}")
-        
-        if not texture_filepath or not os.path.exists(texture_filepath):
-            raise ValueError(f"Texture image not found for product code {short_code}")
-        
-        texture_resource_id = upload_image_to_tensorart(texture_filepath)
+        texture_resource_id = await texture_registry.get(product.full_name, str(product.image), endpoint)
         logger.info(f"Texture resource_id: {texture_resource_id}")
         
         if not texture_resource_id:
-            raise ValueError(f"Failed to upload texture image for {short_code}")
-            
-        time.sleep(10)
+            raise ValueError(f"Failed to upload texture image for {product.code}")
         
         if isinstance(position, (set, list)):
             position = position[0] if position else "default"
             
         logger.info(f"Position: {position}, type: {type(position)}")
         
+        image_width, image_height = image_size or (768, 1024)
+        
         workflow_params = {
             "1": {
                 "classType": "LayerMask: SegmentAnythingUltra V3",
@@ -413,8 +1706,8 @@ def generate_mask(image_resource_id: str, position: str, selected_product_code:
             "2": {
                 "classType": "TensorArt_LoadImage",
                 "inputs": {
-                    "_height": 1024,
-                    "_width": 768,
+                    "_height": image_height,
+                    "_width": image_width,
                     "image": image_resource_id,
                     "upload": "image"
                 },
@@ -428,34 +1721,42 @@ def generate_mask(image_resource_id: str, position: str, selected_product_code:
         }
         
         payload = {
-            "requestId": f"workflow_{int(time.time())}",
+            "requestId": f"workflow_{uuid.uuid4().hex}",
             "params": workflow_params,
-            "runningNotifyUrl": ""
+            "runningNotifyUrl": workflow_completion.notify_url
         }
         
-        output_path = run_workflow(payload, "full_workflow")
+        output_path = await run_workflow(payload, "full_workflow", endpoint, on_submit)
         return output_path
         
+    except UpstreamUnavailable:
+        # Nothing was submitted, so the caller can start over on another endpoint
+        raise
     except Exception as e:
         logger.error(f"Mask generation error: {str(e)}")
         return None
 
-def run_workflow(payload: dict, workflow_name: str) -> str:
-    if not API_KEY_TOKEN or not URL_PRE:
-        raise ValueError("API_KEY_TOKEN and URL_PRE environment variables must be set")
-        
+@timed_stage("run_workflow")
+async def run_workflow(payload: dict, workflow_name: str, endpoint: UpstreamEndpoint,
+                       on_submit: Optional[Callable[[str], Awaitable]] = None) -> str:
     try:
-        url = f"{URL_PRE}/workflow/run"
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Bearer {API_KEY_TOKEN}'
-        }
+        logger.info(f"Running workflow: {workflow_name} on {endpoint.name}")
         
-        logger.info(f"Running workflow: {workflow_name}")
-        
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
+        report_progress("submitting")
+        with observe_stage("workflow_submit"):
+            # The workflow's inputs are resources of this endpoint, so it cannot fail over by itself
+            try:
+                response = await upstream_pool.request(endpoint, "POST", "/workflow/run", json=payload)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                raise UpstreamUnavailable(f"{endpoint.name} could not be reached for a workflow ({type(e).__name__})")
+            except httpx.TransportError as e:
+                upstream_pool.ambiguous(endpoint, "/workflow/run", type(e).__name__)
+                raise
+            if is_refused(response):
+                raise UpstreamUnavailable(f"{endpoint.name} answered {response.status_code} to a workflow")
+            if response.status_code >= 500:
+                upstream_pool.ambiguous(endpoint, "/workflow/run", str(response.status_code))
+            response.raise_for_status()
         
         workflow_response = response.json()
         workflow_id = workflow_response.get('workflowId')
@@ -465,88 +1766,2381 @@ def run_workflow(payload: dict, workflow_name: str) -> str:
             
         logger.info(f"Workflow started with ID: {workflow_id}")
         
-        start_time = time.time()
-        timeout = 300
-        
-        while True:
-            time.sleep(10)
-            elapsed_time = time.time() - start_time
-            
-            if elapsed_time > timeout:
-                raise TimeoutError(f"Workflow timed out after {timeout} seconds")
-                
-            status_url = f"{URL_PRE}/workflow/status/{workflow_id}"
-            status_response = requests.get(status_url, headers=headers)
-            status_response.raise_for_status()
+        workflow_ref = upstream_pool.ref(endpoint, workflow_id)
+        upstream_pool.submitted(workflow_ref)
+        if on_submit is not None:
+            await on_submit(workflow_ref)
+        return await finish_workflow(workflow_ref)
             
-            status_data = status_response.json()
-            workflow_status = status_data.get('status')
-            
-            if workflow_status == 'COMPLETED':
-                output_url = status_data.get('outputUrl')
-                
-                if not output_url:
-                    raise ValueError("No output URL in completed workflow")
-                    
-                output_response = requests.get(output_url)
-                output_response.raise_for_status()
-                
-                output_path = Path(SAVE_DIR) / f"output_{workflow_id}.jpg"
-                
-                with open(output_path, 'wb') as f:
-                    f.write(output_response.content)
-                    
-                logger.info(f"Workflow output saved to: {output_path}")
-                return str(output_path)
-                
-            elif workflow_status in ['FAILED', 'ERROR']:
-                error_message = status_data.get('errorMessage', 'Unknown error')
-                raise RuntimeError(f"Workflow failed: {error_message}")
-                
     except Exception as e:
         logger.error(f"Workflow error: {str(e)}")
         raise
 
+async def finish_workflow(workflow_ref: str) -> str:
+    """Wait for a submitted workflow and move its output into storage."""
+    endpoint, workflow_id = upstream_pool.resolve(workflow_ref)
+
+    async def check_workflow() -> Optional[dict]:
+        status_response = await upstream_pool.request(endpoint, "GET", f"/workflow/status/{workflow_id}")
+        status_response.raise_for_status()
+        
+        status_data = status_response.json()
+        workflow_status = status_data.get('status')
+        report_upstream_status(workflow_ref, workflow_status)
+        
+        if workflow_status == 'COMPLETED':
+            return status_data
+        elif workflow_status in ['FAILED', 'ERROR']:
+            error_message = status_data.get('errorMessage', 'Unknown error')
+            raise RuntimeError(f"Workflow failed: {error_message}")
+        return None
+    
+    try:
+        # Webhook callbacks name the workflow by TensorArt's own ID
+        with observe_stage("workflow_poll"), upstream_pool.busy(endpoint):
+            status_data = await workflow_completion.wait(workflow_id, check_workflow)
+    finally:
+        upstream_pool.forget(workflow_ref)
+    output_url = status_data.get('outputUrl')
+    
+    if not output_url:
+        raise ValueError("No output URL in completed workflow")
+        
+    report_progress("downloading")
+    staged_path = storage.temp_path(".jpg")
+    with observe_stage("workflow_download"):
+        await upstream_client.download(output_url, staged_path)
+    with observe_stage("save"):
+        output_path = await storage.store(staged_path, "jpg")
+        
+    logger.info(f"Workflow output saved to: {output_path}")
+    return str(output_path)
+
+# Storage manager for SAVE_DIR: content-addressed, sharded files with quota and TTL eviction
+STORAGE_DIR = os.getenv("STORAGE_DIR", str(Path(SAVE_DIR) / "objects"))
+STORAGE_MAX_MB = int(os.getenv("STORAGE_MAX_MB", "5120"))
+STORAGE_TTL = int(os.getenv("STORAGE_TTL", str(3 * 24 * 3600)))
+STORAGE_MIN_AGE = int(os.getenv("STORAGE_MIN_AGE", "600"))
+STORAGE_CLEANUP_INTERVAL = int(os.getenv("STORAGE_CLEANUP_INTERVAL", "300"))
+
+class StorageManager:
+    """Stores files as <root>/<ab>/<cd>/<key>.<ext> so lookups never scan a directory.
+
+    Writes are staged under <root>/tmp and renamed into place, so readers never see
+    partial files. A background task enforces the TTL and the disk quota (LRU by mtime,
+    which is refreshed on every read).
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl: int, min_age: int, cleanup_interval: int):
+        self.root = Path(root)
+        self.tmp_dir = self.root / "tmp"
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.min_age = min_age
+        self.cleanup_interval = cleanup_interval
+        self.stats = {"files": 0, "bytes": 0, "evicted": 0, "last_cleanup": None}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.tmp_dir.mkdir(exist_ok=True, parents=True)
+
+    def path_for(self, key: str, ext: str) -> Path:
+        return self.root / key[:2] / key[2:4] / f"{key}.{ext.lstrip('.')}"
+
+    def temp_path(self, suffix: str = "") -> Path:
+        return self.tmp_dir / f"{uuid.uuid4().hex}{suffix}"
+
+    def locate(self, name: str) -> Optional[Path]:
+        key, _, ext = name.partition(".")
+        if len(key) < 4 or not ext or not all(c in "0123456789abcdef" for c in key):
+            return None
+        path = self.path_for(key, ext)
+        if not path.is_file():
+            return None
+        self.touch(path)
+        return path
+
+    def touch(self, path: Path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    async def store(self, tmp_path: Path, ext: str) -> Path:
+        """Move a staged file to its content-addressed location and return the final path."""
+        digest = await asyncio.to_thread(file_sha256, str(tmp_path))
+        return await asyncio.to_thread(self.commit, tmp_path, digest, ext)
+
+    def commit(self, tmp_path: Path, key: str, ext: str) -> Path:
+        path = self.path_for(key, ext)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        if path.exists():
+            # Identical content is already stored; keep the existing copy
+            tmp_path.unlink(missing_ok=True)
+            self.touch(path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+
+    async def start(self):
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self):
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.cleanup)
+            except Exception as e:
+                logger.error(f"Storage cleanup failed: {str(e)}")
+            await asyncio.sleep(self.cleanup_interval)
+
+    def cleanup(self):
+        now = time.time()
+        files = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            is_tmp = shard.path == str(self.tmp_dir)
+            for dirpath, _, filenames in os.walk(shard.path):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if is_tmp:
+                        # Staged files are renamed within seconds; anything old was abandoned
+                        if now - stat.st_mtime > max(self.min_age, 3600):
+                            self._remove(path)
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        kept = 0
+        for mtime, size, path in files:
+            age = now - mtime
+            over_quota = self.max_bytes > 0 and total > self.max_bytes
+            if age > self.ttl or (over_quota and age > self.min_age):
+                if self._remove(path):
+                    total -= size
+                    continue
+            kept += 1
+
+        self.stats.update({"files": kept, "bytes": total, "last_cleanup": now})
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        self.stats["evicted"] += 1
+        return True
+
+storage = StorageManager(STORAGE_DIR, STORAGE_MAX_MB * 1024 * 1024, STORAGE_TTL, STORAGE_MIN_AGE, STORAGE_CLEANUP_INTERVAL)
+
+# Shared state: job records, the result cache index and texture resource IDs live here
+# so every worker process sees the same view. Workers must all run on one host: result
+# files, storage objects and the journal stay in the local SAVE_DIR, and a worker treats
+# an index entry whose file it cannot see as stale.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_PATH = os.getenv("STATE_PATH", str(Path(SAVE_DIR) / "state.sqlite3"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "casla")
+WORKER_HEARTBEAT_INTERVAL = int(os.getenv("WORKER_HEARTBEAT_INTERVAL", "10"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+try:
+    # Only needed for STATE_BACKEND=redis; any Redis-compatible server works
+    import redis
+except ImportError:
+    redis = None
+
+class SQLiteStateBackend:
+    """Namespaced JSON values in one SQLite file (WAL), shared by the workers of one host."""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+
+    def add(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None) -> bool:
+        """Set the value only if the key is absent or expired; True when this call set it."""
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+            " WHERE state.expires_at IS NOT NULL AND state.expires_at <= ?",
+            (namespace, key, json.dumps(value), now + ttl if ttl else None, now)
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, namespace: str, key: str):
+        self._conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace: str) -> Dict[str, dict]:
+        rows = self._conn.execute(
+            "SELECT key, value FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, time.time())
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    def purge(self):
+        self._conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+class RedisStateBackend:
+    """The same interface on a Redis-compatible server, for deployments that already run one.
+
+    It does not make the service multi-host: files are still shared through the local SAVE_DIR.
+
+    Takes a client instead of a URL so a local stand-in with the redis-py API can be used.
+    """
+
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        value = self.client.get(self._key(namespace, key))
+        return json.loads(value) if value is not None else None
+
+    def set(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None):
+        self.client.set(self._key(namespace, key), json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def add(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None) -> bool:
+        px = int(ttl * 1000) if ttl else None
+        return bool(self.client.set(self._key(namespace, key), json.dumps(value), px=px, nx=True))
+
+    def delete(self, namespace: str, key: str):
+        self.client.delete(self._key(namespace, key))
+
+    def items(self, namespace: str) -> Dict[str, dict]:
+        prefix = self._key(namespace, "")
+        keys = list(self.client.scan_iter(match=f"{prefix}*", count=500))
+        values = self.client.mget(keys) if keys else []
+        return {
+            (key.decode() if isinstance(key, bytes) else key)[len(prefix):]: json.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def purge(self):
+        # Redis expires keys on its own
+        pass
+
+def create_state_backend():
+    if STATE_BACKEND == "redis":
+        if redis is None:
+            raise RuntimeError("STATE_BACKEND=redis requires the redis package (pip install redis)")
+        return RedisStateBackend(redis.Redis.from_url(REDIS_URL), REDIS_PREFIX)
+    if STATE_BACKEND != "sqlite":
+        raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}, expected 'sqlite' or 'redis'")
+    return SQLiteStateBackend(STATE_PATH)
+
+class SharedState:
+    """Runs backend calls on one dedicated thread, so they never block the event loop and
+    fire-and-forget writes from publish() are applied in the order they were made."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._live: set = set()
+        self._live_at = 0.0
+
+    async def _call(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, namespace: str, key: str) -> Optional[dict]:
+        return await self._call(self.backend.get, namespace, key)
+
+    async def set(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None):
+        await self._call(self.backend.set, namespace, key, value, ttl)
+
+    async def add(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None) -> bool:
+        return await self._call(self.backend.add, namespace, key, value, ttl)
+
+    async def delete(self, namespace: str, key: str):
+        await self._call(self.backend.delete, namespace, key)
+
+    async def items(self, namespace: str) -> Dict[str, dict]:
+        return await self._call(self.backend.items, namespace)
+
+    def publish(self, namespace: str, key: str, value: dict, ttl: Optional[float] = None):
+        future = self._executor.submit(self.backend.set, namespace, key, value, ttl)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            logger.error(f"Shared state write failed: {future.exception()}")
+
+    async def start(self):
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        await self.delete("workers", WORKER_ID)
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.set("workers", WORKER_ID, {"pid": os.getpid(), "seen_at": time.time()},
+                               ttl=WORKER_HEARTBEAT_INTERVAL * 3)
+                # Expired rows are only filtered out by reads; deleting them is a write, so do it here
+                await self._call(self.backend.purge)
+            except Exception as e:
+                logger.error(f"Worker heartbeat failed: {str(e)}")
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+    async def live_workers(self) -> set:
+        # Heartbeats land every WORKER_HEARTBEAT_INTERVAL, so a fresher view buys nothing
+        if time.time() - self._live_at > WORKER_HEARTBEAT_INTERVAL:
+            self._live = set(await self.items("workers"))
+            self._live_at = time.time()
+        return self._live
+
+shared_state = SharedState(create_state_backend())
+
+# Result cache for text2img, keyed on everything that influences the generated image
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", str(Path(SAVE_DIR) / "cache"))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "1024"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_EVICT_INTERVAL = int(os.getenv("RESULT_CACHE_EVICT_INTERVAL", "60"))
+# Renders are indexed seconds after they land, so anything unindexed this old was abandoned
+RESULT_CACHE_ORPHAN_AGE = 3600
+
+def text2img_cache_key(prompt: str, width: int, height: int, product_codes: List[str]) -> str:
+    key_data = {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "product_codes": sorted(product_codes),
+        "model": TXT2IMG_MODEL_ID,
+        "vae": TXT2IMG_VAE_ID,
+        "sampler": TXT2IMG_SAMPLER_PARAMS,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    """On-disk PNG cache evicted by age and total size (LRU).
+
+    The index lives in shared state, so a result rendered by one worker is a hit on all of them.
+    A background pass evicts entries and sweeps files the index doesn't know: interrupted
+    downloads, losing hedges and renders left over from when the cache was disabled.
+    """
+
+    namespace = "result_cache"
+
+    def __init__(self, directory: str, max_bytes: int, max_age: int, state: SharedState):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.state = state
+        self.legacy_index_path = self.directory / "index.json"
+        self._evict_task: Optional[asyncio.Task] = None
+        self.directory.mkdir(exist_ok=True, parents=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def output_path(self, key: str) -> Path:
+        """Where a new render is written; without the cache it goes to storage and its quota."""
+        if self.enabled:
+            return self.path_for(key)
+        path = storage.path_for(key, "png")
+        path.parent.mkdir(exist_ok=True, parents=True)
+        return path
+
+    async def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        entry = await self.state.get(self.namespace, key)
+        path = self.path_for(key)
+        if entry is not None and (time.time() - entry["created_at"] > self.max_age or not path.exists()):
+            await self.state.delete(self.namespace, key)
+            entry = None
+        if entry is None:
+            CACHE_REQUESTS.inc("result", "miss")
+            return None
+        CACHE_REQUESTS.inc("result", "hit")
+        self.state.publish(self.namespace, key, {**entry, "last_access": time.time()})
+        return str(path)
+
+    async def put(self, key: str, path: Path):
+        if not self.enabled:
+            return
+        now = time.time()
+        await self.state.set(self.namespace, key, {"size": path.stat().st_size, "created_at": now, "last_access": now})
+
+    async def start(self):
+        self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def stop(self):
+        if self._evict_task:
+            self._evict_task.cancel()
+            await asyncio.gather(self._evict_task, return_exceptions=True)
+            self._evict_task = None
+
+    async def _evict_loop(self):
+        while True:
+            try:
+                await self.evict()
+            except Exception as e:
+                logger.error(f"Result cache eviction failed: {str(e)}")
+            await asyncio.sleep(RESULT_CACHE_EVICT_INTERVAL)
+
+    async def evict(self):
+        entries = await self.state.items(self.namespace) if self.enabled else {}
+        now = time.time()
+        removed = [key for key, entry in entries.items() if now - entry["created_at"] > self.max_age]
+        for key in removed:
+            del entries[key]
+
+        total = sum(entry["size"] for entry in entries.values())
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["size"]
+            removed.append(key)
+
+        for key in removed:
+            await self.state.delete(self.namespace, key)
+        await asyncio.to_thread(self._remove_files, [self.path_for(key) for key in removed])
+        kept = {self.path_for(key).name for key in entries if key not in removed}
+        await asyncio.to_thread(self._sweep, kept)
+
+    def _remove_files(self, paths: List[Path]):
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def _sweep(self, indexed: set):
+        """Remove old files in the cache directory that no index entry points to."""
+        cutoff = time.time() - RESULT_CACHE_ORPHAN_AGE
+        for entry in os.scandir(self.directory):
+            if entry.name in indexed or entry.path == str(self.legacy_index_path) or not entry.is_file():
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    async def import_legacy_index(self):
+        # Older releases kept the index in index.json next to the images
+        try:
+            entries = json.loads(await asyncio.to_thread(self.legacy_index_path.read_text))
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning(f"Ignoring corrupt result cache index: {e}")
+            entries = {}
+        for key, entry in entries.items():
+            if self.path_for(key).exists():
+                await self.state.add(self.namespace, key, entry)
+        self.legacy_index_path.rename(self.legacy_index_path.with_suffix(".json.imported"))
+        logger.info(f"Imported {len(entries)} result cache entries from {self.legacy_index_path}")
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024, RESULT_CACHE_TTL, shared_state)
+
+# Generation journal: records every paid upstream job so a restart can finish it instead of paying twice
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", str(Path(SAVE_DIR) / "journal.sqlite3"))
+JOURNAL_TTL = int(os.getenv("JOURNAL_TTL", str(7 * 24 * 3600)))
+JOURNAL_PRUNE_INTERVAL = 3600
+JOURNAL_WAIT_INTERVAL = float(os.getenv("JOURNAL_WAIT_INTERVAL", "1"))
+
+class GenerationJournal:
+    """SQLite (WAL) log of upstream generations, keyed like their single-flight calls.
+
+    A row is written before the job is submitted, gets the TensorArt job or workflow ID
+    as soon as it is known and ends with the output path or the error. Every row names
+    the worker that owns it; rows whose owner stopped sending heartbeats are resumed by
+    the workers that are still alive, and by this one at startup.
+    """
+
+    def __init__(self, path: str, ttl: int, state: SharedState):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.state = state
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " key TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL,"
+            " status TEXT NOT NULL, upstream_id TEXT, output_path TEXT, error TEXT,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+        )
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(generations)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE generations ADD COLUMN owner TEXT")
+        self._last_prune = 0.0
+        self._recovery_tasks: List[asyncio.Task] = []
+        self._adopt_task: Optional[asyncio.Task] = None
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _execute_count(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    async def begin(self, key: str, kind: str, params: dict) -> bool:
+        """Claim the key for this worker; False while another worker is still generating it."""
+        now = time.time()
+        claimed = await asyncio.to_thread(
+            self._execute_count,
+            "INSERT INTO generations (key, kind, params, status, created_at, updated_at, owner)"
+            " VALUES (?, ?, ?, 'submitting', ?, ?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET kind = excluded.kind, params = excluded.params,"
+            " status = 'submitting', upstream_id = NULL, output_path = NULL, error = NULL,"
+            " created_at = excluded.created_at, updated_at = excluded.updated_at, owner = excluded.owner"
+            " WHERE generations.status IN ('succeeded', 'failed') OR generations.owner = excluded.owner",
+            (key, kind, json.dumps(params), now, now, WORKER_ID)
+        )
+        if now - self._last_prune > JOURNAL_PRUNE_INTERVAL:
+            self._last_prune = now
+            await asyncio.to_thread(self.prune)
+        return claimed > 0
+
+    async def submitted(self, key: str, upstream_id: str):
+        await self._update(key, "running", upstream_id=upstream_id)
+
+    async def track(self, key: str, work: Awaitable[str]) -> str:
+        """Record how a journaled generation ends.
+
+        Cancellation after submission is deliberately not recorded: the upstream job keeps
+        running and the next process resumes it. Cancelled before submission, the key is
+        given up so that the next caller can claim it.
+        """
+        try:
+            output_path = await work
+            if not output_path:
+                raise RuntimeError("Failed to generate image.")
+        except asyncio.CancelledError:
+            await asyncio.to_thread(
+                self._execute, "DELETE FROM generations WHERE key = ? AND owner = ? AND status = 'submitting'",
+                (key, WORKER_ID)
+            )
+            raise
+        except Exception as e:
+            await self._update(key, "failed", error=str(e))
+            raise
+        await self._update(key, "succeeded", output_path=output_path)
+        return output_path
+
+    async def _update(self, key: str, status: str, **fields):
+        assignments = "".join(f", {name} = ?" for name in fields)
+        await asyncio.to_thread(
+            self._execute,
+            f"UPDATE generations SET status = ?, updated_at = ?{assignments} WHERE key = ?",
+            (status, time.time(), *fields.values(), key)
+        )
+
+    async def result(self, key: str) -> Optional[str]:
+        """Output of an earlier successful generation, if it is still on disk."""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT output_path FROM generations WHERE key = ? AND status = 'succeeded' AND updated_at > ?",
+            (key, time.time() - self.ttl)
+        )
+        if rows and os.path.exists(rows[0]["output_path"]):
+            CACHE_REQUESTS.inc("journal", "hit")
+            return rows[0]["output_path"]
+        CACHE_REQUESTS.inc("journal", "miss")
+        return None
+
+    async def wait_for(self, key: str, timeout: float) -> Optional[str]:
+        """Wait for a generation owned by another worker to finish; None if it was given up unsubmitted."""
+        logger.info(f"Waiting for another worker to finish {key}")
+        report_progress("running", shared=True)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            await asyncio.sleep(JOURNAL_WAIT_INTERVAL)
+            rows = await asyncio.to_thread(
+                self._execute, "SELECT status, output_path, error FROM generations WHERE key = ?", (key,)
+            )
+            if not rows:
+                return None
+            if rows[0]["status"] == "succeeded":
+                return rows[0]["output_path"]
+            if rows[0]["status"] == "failed":
+                raise RuntimeError(rows[0]["error"] or "Failed to generate image.")
+        raise TimeoutError(f"{key} did not finish within {timeout} seconds")
+
+    def prune(self):
+        self._execute("DELETE FROM generations WHERE updated_at < ? AND status IN ('succeeded', 'failed')",
+                      (time.time() - self.ttl,))
+
+    async def start(self, resume: Callable[[dict], Awaitable[str]]):
+        # Rows this worker ID owns come from a previous process with the same PID
+        await self._adopt(resume, include_own=True)
+        self._adopt_task = asyncio.create_task(self._adopt_loop(resume))
+
+    async def stop(self):
+        if self._adopt_task:
+            self._adopt_task.cancel()
+            await asyncio.gather(self._adopt_task, return_exceptions=True)
+            self._adopt_task = None
+
+    async def _adopt_loop(self, resume: Callable[[dict], Awaitable[str]]):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL * 3)
+            try:
+                await self._adopt(resume, include_own=False)
+            except Exception as e:
+                logger.error(f"Journal recovery failed: {str(e)}")
+
+    async def _adopt(self, resume: Callable[[dict], Awaitable[str]], include_own: bool):
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT * FROM generations WHERE status IN ('submitting', 'running')"
+        )
+        if not rows:
+            return
+        live_workers = await self.state.live_workers()
+        for row in rows:
+            owner = row["owner"]
+            if owner == WORKER_ID and not include_own:
+                continue
+            if owner != WORKER_ID and owner in live_workers:
+                continue
+            # Several workers may notice the same orphan; only one wins the claim
+            claimed = await asyncio.to_thread(
+                self._execute_count,
+                "UPDATE generations SET owner = ?, updated_at = ? WHERE key = ? AND owner IS ? AND status = ?",
+                (WORKER_ID, time.time(), row["key"], owner, row["status"])
+            )
+            if not claimed:
+                continue
+            if row["status"] == "submitting":
+                # Jobs that died before TensorArt answered have no ID to resume
+                await self._update(row["key"], "failed", error="Interrupted before submission")
+                continue
+            entry = {**dict(row), "params": json.loads(row["params"])}
+            logger.info(f"Resuming {entry['kind']} upstream job {entry['upstream_id']} from the journal")
+            # A request for the key may already be in flight, waiting for this very row to finish:
+            # the resume takes over the key instead of joining it, and that request sees the row end
+            work = single_flight.lead(entry["key"], lambda entry=entry: self.track(entry["key"], resume(entry)))
+            task = asyncio.create_task(work)
+            task.add_done_callback(self._recovered)
+            self._recovery_tasks.append(task)
+
+    def _recovered(self, task: asyncio.Task):
+        self._recovery_tasks.remove(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Resumed generation failed: {task.exception()}")
+
+    def stats(self) -> dict:
+        rows = self._execute("SELECT status, COUNT(*) AS count FROM generations GROUP BY status")
+        return {"resuming": len(self._recovery_tasks), **{row["status"]: row["count"] for row in rows}}
+
+journal = GenerationJournal(JOURNAL_PATH, JOURNAL_TTL, shared_state)
+
+# Texture resource registry: product textures never change, so their TensorArt
+# resource IDs are reused until shortly before the upload expires
+TEXTURE_REFRESH_MARGIN = int(os.getenv("TEXTURE_REFRESH_MARGIN", "900"))
+TEXTURE_REFRESH_INTERVAL = int(os.getenv("TEXTURE_REFRESH_INTERVAL", "60"))
+TEXTURE_WARMUP = os.getenv("TEXTURE_WARMUP", "false").lower() in ("1", "true", "yes")
+
+@dataclass
+class TextureResource:
+    resource_id: str
+    filepath: str
+    expires_at: float
+    endpoint: str = ""
+
+class TextureRegistry:
+    """Resource IDs are shared between workers, so each texture is uploaded once per expiry
+    period rather than once per process. Resources belong to one upstream endpoint, so
+    they are tracked per endpoint and product code."""
+
+    namespace = "textures"
+
+    def __init__(self, expire_sec: int, refresh_margin: int, refresh_interval: int, state: SharedState):
+        self.expire_sec = expire_sec
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.state = state
+        self.resources: Dict[str, TextureResource] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _is_fresh(self, resource: Optional[TextureResource]) -> bool:
+        return resource is not None and resource.expires_at - time.time() > self.refresh_margin
+
+    async def get(self, product_code: str, filepath: str, endpoint: UpstreamEndpoint) -> Optional[str]:
+        key = f"{endpoint.name}:{product_code}"
+        resource = self.resources.get(key)
+        if not (self._is_fresh(resource) and resource.filepath == filepath):
+            # Another worker may have uploaded it already
+            shared = await self.state.get(self.namespace, key)
+            resource = TextureResource(**shared) if shared else None
+            if self._is_fresh(resource):
+                self.resources[key] = resource
+        if self._is_fresh(resource) and resource.filepath == filepath:
+            CACHE_REQUESTS.inc("texture", "hit")
+            logger.info(f"Reusing texture resource for {product_code} on {endpoint.name}: {resource.resource_id}")
+            return resource.resource_id
+        CACHE_REQUESTS.inc("texture", "miss")
+        return await self._upload(key, filepath, endpoint)
+
+    async def _upload(self, key: str, filepath: str, endpoint: UpstreamEndpoint) -> Optional[str]:
+        async def upload() -> Optional[str]:
+            uploaded_at = time.time()
+            resource_id = await upload_image_to_tensorart(filepath, endpoint)
+            if not resource_id:
+                return None
+            resource = TextureResource(resource_id, filepath, uploaded_at + self.expire_sec, endpoint.name)
+            self.resources[key] = resource
+            await self.state.set(self.namespace, key, asdict(resource), ttl=self.expire_sec)
+            return resource_id
+
+        # Concurrent requests for the same texture share a single upload
+        return await single_flight.do(f"texture:{key}:{filepath}", upload)
+
+    async def start(self, warmup: bool = False):
+        self._refresh_task = asyncio.create_task(self._refresh_loop(warmup))
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+    async def warmup(self):
+        textures = [(product.full_name, str(product.image)) for product in load_catalog().available()]
+        endpoints = upstream_pool.endpoints
+        logger.info(f"Warming up {len(textures)} texture resources on {len(endpoints)} endpoints")
+        await asyncio.gather(*(
+            self.get(code, path, endpoint) for code, path in textures for endpoint in endpoints
+        ))
+
+    async def _refresh_loop(self, warmup: bool):
+        if warmup:
+            try:
+                await self.warmup()
+            except Exception as e:
+                logger.error(f"Texture warmup failed: {str(e)}")
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            # Re-upload before expiry so requests never wait on a texture upload
+            try:
+                shared = await self.state.items(self.namespace)
+            except Exception as e:
+                logger.error(f"Texture refresh failed: {str(e)}")
+                continue
+            expiring = [
+                (key, resource["filepath"], upstream_pool.get(resource.get("endpoint", "")))
+                for key, resource in shared.items()
+                if resource["expires_at"] - time.time() <= self.refresh_margin + self.refresh_interval
+            ]
+            for key, filepath, endpoint in expiring:
+                if endpoint is None:
+                    # Uploaded through an endpoint that is no longer configured
+                    continue
+                # Only one worker refreshes each texture
+                if not await self.state.add("locks", f"texture-refresh:{key}", {"owner": WORKER_ID},
+                                            ttl=self.refresh_interval):
+                    continue
+                logger.info(f"Refreshing texture resource {key}")
+                try:
+                    await self._upload(key, filepath, endpoint)
+                except Exception as e:
+                    logger.error(f"Texture refresh failed for {key}: {str(e)}")
+
+texture_registry = TextureRegistry(RESOURCE_EXPIRE_SEC, TEXTURE_REFRESH_MARGIN, TEXTURE_REFRESH_INTERVAL, shared_state)
+
+# Upstream scheduler: caps concurrent TensorArt jobs, shares slots fairly between
+# clients and lets interactive text2img requests overtake batch img2img work
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "8"))
+# The cap is for the whole deployment; each of WEB_CONCURRENCY workers takes its share
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+UPSTREAM_QUEUE_LIMIT = int(os.getenv("UPSTREAM_QUEUE_LIMIT", "50"))
+LANE_INTERACTIVE = 0
+LANE_BATCH = 1
+
+class SchedulerFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream capacity exhausted, please retry later")
+        self.retry_after = retry_after
+
+class UpstreamScheduler:
+    def __init__(self, max_in_flight: int, queue_limit: int):
+        self.max_in_flight = max_in_flight
+        self.queue_limit = queue_limit
+        self.in_flight = 0
+        self.waiting = 0
+        # One round-robin ring of per-client FIFOs per lane, highest priority first
+        self.lanes: List[OrderedDict] = [OrderedDict(), OrderedDict()]
+        self.avg_duration = 30.0
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + 1) / max(self.max_in_flight, 1)
+        return max(1, math.ceil(backlog * self.avg_duration))
+
+    def check_capacity(self):
+        if self.waiting >= self.queue_limit:
+            raise SchedulerFull(self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, client_id: str, lane: int, shed: bool = True, charge: bool = True):
+        """charge=False for work the client already paid for, such as resuming a journaled job."""
+        await self.acquire(client_id, lane, shed)
+        # From here the work goes upstream, so it runs to completion even if its callers leave
+        single_flight.commit()
+        started_at = time.time()
+        if charge:
+            admission.charge(client_id)
+        try:
+            yield
+        except BaseException:
+            # Clients pay for generations that produce a result
+            if charge:
+                admission.refund(client_id)
+            raise
+        finally:
+            elapsed = time.time() - started_at
+            self.avg_duration = 0.9 * self.avg_duration + 0.1 * elapsed
+            # A slot covers the upstream work of one generation, so this is what it cost
+            admission.record(client_id, upstream_seconds=elapsed)
+            self.release()
+
+    async def acquire(self, client_id: str, lane: int, shed: bool = True):
+        if self.in_flight < self.max_in_flight and self.waiting == 0:
+            self.in_flight += 1
+            return
+        if shed:
+            self.check_capacity()
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self.lanes[lane].setdefault(client_id, deque())
+        queue.append(waiter)
+        self.waiting += 1
+        report_progress("queued", waiting=self.waiting)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self.release()
+            else:
+                queue.remove(waiter)
+                if not queue and self.lanes[lane].get(client_id) is queue:
+                    del self.lanes[lane][client_id]
+                self.waiting -= 1
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self.in_flight < self.max_in_flight:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self.waiting -= 1
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for lane in self.lanes:
+            if lane:
+                client_id, queue = next(iter(lane.items()))
+                waiter = queue.popleft()
+                if queue:
+                    lane.move_to_end(client_id)
+                else:
+                    del lane[client_id]
+                return waiter
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self.waiting,
+            "queue_limit": self.queue_limit,
+            "waiting_by_lane": [sum(len(queue) for queue in lane.values()) for lane in self.lanes],
+            "avg_job_seconds": round(self.avg_duration, 2),
+        }
+
+upstream_scheduler = UpstreamScheduler(max(1, math.ceil(UPSTREAM_MAX_IN_FLIGHT / WEB_CONCURRENCY)), UPSTREAM_QUEUE_LIMIT)
+
+metrics.register(Gauge("casla_upstream_jobs_in_flight", "TensorArt jobs holding a scheduler slot",
+                       lambda: upstream_scheduler.in_flight))
+metrics.register(Gauge("casla_upstream_jobs_waiting", "Requests waiting for a scheduler slot",
+                       lambda: upstream_scheduler.waiting))
+
+@app.exception_handler(SchedulerFull)
+async def scheduler_full_handler(request: Request, exc: SchedulerFull):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# Admission control: callers present a client key, spend a token from their bucket on every
+# request and are held to a daily job quota. Checks are dictionary lookups on this worker;
+# usage is summed across workers through shared state in the background. Without CLIENT_KEYS
+# callers are only accounted: browsers share the frontend's key and proxied callers share an
+# address, so limiting them would throttle the whole site as one client.
+CLIENT_KEYS = os.getenv("CLIENT_KEYS", "")
+# Requests per second per client (0 disables the limit) and how many may arrive at once
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "2"))
+CLIENT_BURST = int(os.getenv("CLIENT_BURST", "20"))
+# Upstream jobs per client per UTC day; 0 means unlimited
+CLIENT_DAILY_JOBS = int(os.getenv("CLIENT_DAILY_JOBS", "200"))
+CLIENT_USAGE_SYNC_INTERVAL = float(os.getenv("CLIENT_USAGE_SYNC_INTERVAL", "5"))
+
+ADMISSION_REJECTIONS = metrics.register(Counter(
+    "casla_admission_rejections_total", "Requests turned away by admission control", ("reason",)
+))
+
+def parse_client_keys(value: str) -> Dict[str, str]:
+    """Map sha256(key) to client name for "name:key" entries; the keys themselves are not kept."""
+    clients = {}
+    for entry in split_list(value):
+        name, _, key = entry.partition(":")
+        if not name or not key or "|" in name:
+            raise ValueError(f"CLIENT_KEYS entry for {name or '?'!r} must look like name:key")
+        clients[hashlib.sha256(key.encode()).hexdigest()] = name
+    return clients
+
+def utc_day() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+def seconds_until_utc_midnight() -> int:
+    return 86400 - int(time.time()) % 86400
+
+@dataclass
+class TokenBucket:
+    tokens: float
+    updated_at: float
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Spend one token; returns 0 on success, otherwise seconds until one is available."""
+        self.refill(rate, burst, now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+@dataclass
+class ClientUsage:
+    requests: int = 0
+    rejected: int = 0
+    jobs: int = 0
+    upstream_seconds: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+    def add(self, other: "ClientUsage"):
+        for name, value in asdict(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+class AdmissionControl:
+    """Per-client authentication, token-bucket rate limits, daily job quotas and usage.
+
+    Each worker counts its own usage for the current UTC day and publishes it under
+    "day|client|worker"; the totals of the other workers are refreshed every sync, so a
+    quota check is this worker's count plus a cached sum. Records outlive the worker,
+    which keeps a restart from handing out a fresh quota.
+    """
+
+    namespace = "usage"
+
+    def __init__(self, state: SharedState, clients: Dict[str, str], rate: float, burst: float,
+                 daily_jobs: int, sync_interval: float):
+        self.state = state
+        self.clients = clients
+        self.rate = rate
+        self.burst = burst
+        self.daily_jobs = daily_jobs
+        self.sync_interval = sync_interval
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.day = utc_day()
+        self.usage: Dict[str, ClientUsage] = {}
+        self.elsewhere: Dict[str, ClientUsage] = {}
+        # Admitted generations that have not finished, and those among them already charged
+        self.reserved: Dict[str, int] = {}
+        self.consumed: Dict[str, int] = {}
+        self._dirty: set = set()
+        self._sync_task: Optional[asyncio.Task] = None
+        # Every worker derives the same secret from the configured keys
+        self._token_secret = hashlib.sha256("|".join(sorted(clients)).encode()).digest()
+
+    def authenticate(self, request: Request) -> str:
+        if not self.clients:
+            # No client keys configured: open access, metered per caller
+            return get_caller_id(request)
+        scheme, _, key = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer":
+            key = request.headers.get("x-api-key", "")
+        client = self.clients.get(hashlib.sha256(key.strip().encode()).hexdigest()) if key else None
+        if client is None:
+            ADMISSION_REJECTIONS.inc("unauthenticated")
+            raise HTTPException(
+                status_code=401,
+                detail="A valid client key is required",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        return client
+
+    @property
+    def enforcing(self) -> bool:
+        return bool(self.clients)
+
+    def admit(self, client: str):
+        if not self.enforcing or not self.rate:
+            self._usage(client).requests += 1
+            return
+        now = time.monotonic()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.burst, now)
+        usage = self._usage(client)
+        wait = bucket.take(self.rate, self.burst, now)
+        if wait:
+            usage.rejected += 1
+            ADMISSION_REJECTIONS.inc("rate_limited")
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded, please slow down",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+        usage.requests += 1
+
+    def job_token(self, client: str, job_id: str, ttl: float) -> str:
+        """Credential for one job's event stream, for clients that can only pass it in the URL."""
+        expires = int(time.time() + ttl)
+        return f"{expires}.{self._sign_job(client, job_id, expires)}"
+
+    def check_job_token(self, client: str, job_id: str, token: str) -> bool:
+        expires, _, signature = token.partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(signature, self._sign_job(client, job_id, int(expires)))
+
+    def _sign_job(self, client: str, job_id: str, expires: int) -> str:
+        return hmac.new(self._token_secret, f"{client}|{job_id}|{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def owns(self, client: str, owner: str) -> bool:
+        # Unkeyed callers have no identity worth checking
+        return not self.enforcing or client == owner
+
+    def jobs_used(self, client: str) -> int:
+        own = self._usage(client).jobs
+        other = self.elsewhere.get(client)
+        return own + (other.jobs if other else 0)
+
+    def check_quota(self, client: str, count: int = 1):
+        """Refuse count more jobs if they don't fit next to the ones already used and admitted."""
+        pending = self.reserved.get(client, 0)
+        if self.enforcing and self.daily_jobs and self.jobs_used(client) + pending + count > self.daily_jobs:
+            self._usage(client).rejected += 1
+            ADMISSION_REJECTIONS.inc("quota")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Daily quota of {self.daily_jobs} jobs reached",
+                headers={"Retry-After": str(seconds_until_utc_midnight())}
+            )
+
+    def reserve(self, client: str, count: int = 1):
+        """Hold quota for admitted generations until release(); only upstream work is charged."""
+        self.check_quota(client, count)
+        self.reserved[client] = self.reserved.get(client, 0) + count
+
+    def release(self, client: str, count: int = 1):
+        for _ in range(count):
+            # A reservation the upstream charge already took over leaves nothing to free
+            if self.consumed.get(client, 0) > 0:
+                self._decrement(self.consumed, client)
+            else:
+                self._decrement(self.reserved, client)
+
+    def charge(self, client: str):
+        """Count one upstream job, taking over one of the client's reservations if it holds any."""
+        self._usage(client).jobs += 1
+        if self.reserved.get(client, 0) > 0:
+            self._decrement(self.reserved, client)
+            self.consumed[client] = self.consumed.get(client, 0) + 1
+
+    def refund(self, client: str):
+        self._usage(client).jobs -= 1
+
+    @staticmethod
+    def _decrement(counts: Dict[str, int], client: str):
+        if counts.get(client, 0) > 1:
+            counts[client] -= 1
+        else:
+            counts.pop(client, None)
+
+    def record(self, client: str, upstream_seconds: float = 0.0, bytes_in: int = 0, bytes_out: int = 0):
+        usage = self._usage(client)
+        usage.upstream_seconds += upstream_seconds
+        usage.bytes_in += bytes_in
+        usage.bytes_out += bytes_out
+
+    def _usage(self, client: str) -> ClientUsage:
+        day = utc_day()
+        if day != self.day:
+            self.day = day
+            self.usage.clear()
+            self.elsewhere.clear()
+            self._dirty.clear()
+        self._dirty.add(client)
+        usage = self.usage.get(client)
+        if usage is None:
+            usage = self.usage[client] = ClientUsage()
+        return usage
+
+    def describe(self, client: str) -> dict:
+        usage = ClientUsage()
+        usage.add(self._usage(client))
+        if client in self.elsewhere:
+            usage.add(self.elsewhere[client])
+        bucket = self.buckets.get(client)
+        if bucket is not None:
+            bucket.refill(self.rate, self.burst, time.monotonic())
+        return {
+            "client": client,
+            "day": self.day,
+            "usage": {**asdict(usage), "upstream_seconds": round(usage.upstream_seconds, 3)},
+            "limits": None if not self.enforcing else {
+                "requests_per_second": self.rate,
+                "burst": self.burst,
+                "tokens": round(bucket.tokens, 2) if bucket else self.burst,
+                "daily_jobs": self.daily_jobs or None,
+                "jobs_remaining": max(0, self.daily_jobs - usage.jobs - self.reserved.get(client, 0))
+                if self.daily_jobs else None,
+            },
+        }
+
+    async def start(self):
+        await self.sync(restore=True)
+        self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._sync_task:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            self._sync_task = None
+        await self.sync()
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Client usage sync failed: {str(e)}")
+
+    async def sync(self, restore: bool = False):
+        """Publish this worker's changed usage and pick up everyone else's.
+
+        With restore, usage published under this worker's ID (a restart that kept its
+        hostname and PID, as in containers) is taken back instead of being overwritten.
+        """
+        day = self.day
+        for client in self._dirty:
+            self.state.publish(self.namespace, f"{day}|{client}|{WORKER_ID}", asdict(self.usage[client]),
+                               ttl=2 * 86400)
+        self._dirty.clear()
+
+        elsewhere: Dict[str, ClientUsage] = {}
+        for key, value in (await self.state.items(self.namespace)).items():
+            record_day, _, rest = key.partition("|")
+            client, _, worker = rest.rpartition("|")
+            if record_day != day:
+                continue
+            if worker == WORKER_ID:
+                if restore and client not in self.usage:
+                    self.usage[client] = ClientUsage(**value)
+                continue
+            elsewhere.setdefault(client, ClientUsage()).add(ClientUsage(**value))
+        if self.day == day:
+            self.elsewhere = elsewhere
+
+        # A bucket that has refilled is no different from a new one
+        now = time.monotonic()
+        for client, bucket in list(self.buckets.items()):
+            bucket.refill(self.rate, self.burst, now)
+            if bucket.tokens >= self.burst:
+                del self.buckets[client]
+
+# Limits are for the whole deployment; each of WEB_CONCURRENCY workers takes its share
+admission = AdmissionControl(
+    shared_state,
+    parse_client_keys(CLIENT_KEYS),
+    rate=CLIENT_RATE_LIMIT / WEB_CONCURRENCY,
+    burst=max(1.0, CLIENT_BURST / WEB_CONCURRENCY),
+    daily_jobs=CLIENT_DAILY_JOBS,
+    sync_interval=CLIENT_USAGE_SYNC_INTERVAL,
+)
+
+# Single-flight: concurrent identical generations or uploads share one upstream call
+class Flight:
+    """One shared call: its task, how many callers wait on it and whether it may still be called off."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.task: Optional[asyncio.Task] = None
+        self.progress = ProgressFanout()
+        self.waiters = 0
+        self.committed = False
+
+flight_var: ContextVar[Optional[Flight]] = ContextVar("flight", default=None)
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, Flight] = {}
+        # Caller task -> the call it is waiting on, so a job can tell whether cancelling it stops anything
+        self._waiting: Dict[asyncio.Task, Flight] = {}
+        self.stats = {"calls": 0, "shared": 0, "abandoned": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._start(key, fn)
+        else:
+            self.stats["shared"] += 1
+            logger.info(f"Joining in-flight call {key}")
+        return await self._wait(flight)
+
+    async def lead(self, key: str, fn: Callable[[], Awaitable]):
+        """Run fn as the call for key even if another one is in flight; later callers join this one."""
+        return await self._wait(self._start(key, fn))
+
+    def commit(self):
+        """Called from inside a call once it starts work that must finish even if every caller leaves."""
+        flight = flight_var.get()
+        if flight is not None:
+            flight.committed = True
+
+    def cancellable(self, task: asyncio.Task) -> bool:
+        """Whether cancelling task also stops the call it waits on, if it waits on one."""
+        flight = self._waiting.get(task)
+        return flight is None or not flight.committed
+
+    def _start(self, key: str, fn: Callable[[], Awaitable]) -> Flight:
+        self.stats["calls"] += 1
+        flight = Flight(key)
+        # The work runs in its own task so one caller disconnecting does not fail the others;
+        # its progress goes to every caller, not just the one that started it
+        progress_token = progress_var.set(flight.progress)
+        flight_token = flight_var.set(flight)
+        try:
+            flight.task = asyncio.create_task(fn())
+        finally:
+            flight_var.reset(flight_token)
+            progress_var.reset(progress_token)
+        self._calls[key] = flight
+        flight.task.add_done_callback(lambda done, flight=flight: self._forget(flight))
+        return flight
+
+    async def _wait(self, flight: Flight):
+        reporter = progress_var.get()
+        if reporter is not None:
+            flight.progress.add(reporter)
+        caller = asyncio.current_task()
+        flight.waiters += 1
+        self._waiting[caller] = flight
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            self._waiting.pop(caller, None)
+            if reporter is not None:
+                flight.progress.remove(reporter)
+            if not flight.waiters and not flight.committed and not flight.task.done():
+                # Everyone left before the call reached upstream: nobody is left to use its result
+                logger.info(f"Abandoning call {flight.key}")
+                self.stats["abandoned"] += 1
+                flight.task.cancel()
+                self._drop(flight)
+
+    def _drop(self, flight: Flight):
+        if self._calls.get(flight.key) is flight:
+            del self._calls[flight.key]
+
+    def _forget(self, flight: Flight):
+        self._drop(flight)
+        if not flight.task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            flight.task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+single_flight = SingleFlight()
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Derivative renditions, rendered in a process pool and kept in storage keyed by source hash + params
+DERIVATIVE_MAX_AGE = int(os.getenv("DERIVATIVE_MAX_AGE", "86400"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+DERIVATIVE_MEDIA_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp", "avif": "image/avif"}
+# Anyone holding an image URL can ask for renditions, so requests are snapped to a few sizes
+# and qualities; each image then has a small, fixed set of renditions to render and store
+DERIVATIVE_SIZES = sorted(int(size) for size in split_list(os.getenv("DERIVATIVE_SIZES", "128,256,512,1024,2048")))
+DERIVATIVE_QUALITIES = sorted(int(quality) for quality in split_list(os.getenv("DERIVATIVE_QUALITIES", "60,80,90")))
+
+try:
+    # AVIF encoding needs the optional pillow-avif-plugin on Pillow < 11
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _image_pool
+
+def derivative_formats() -> set:
+    Image.init()
+    return {name for name in DERIVATIVE_MEDIA_TYPES if name.upper() in Image.SAVE}
+
+def snap_size(value: Optional[int]) -> Optional[int]:
+    """The smallest supported size that is at least value, or the largest one."""
+    if value is None:
+        return None
+    index = bisect.bisect_left(DERIVATIVE_SIZES, value)
+    return DERIVATIVE_SIZES[min(index, len(DERIVATIVE_SIZES) - 1)]
+
+def snap_quality(value: int) -> int:
+    return min(DERIVATIVE_QUALITIES, key=lambda quality: abs(quality - value))
+
+def guess_image_media_type(path: Path) -> str:
+    return {".png": "image/png", ".webp": "image/webp"}.get(path.suffix.lower(), "image/jpeg")
+
+def find_image(name: str) -> Optional[Path]:
+    # Only plain file names are accepted, never paths
+    if Path(name).name != name or name.startswith("."):
+        return None
+    path = storage.locate(name)
+    if path is None:
+        # The result cache also holds partial downloads, hedges and its legacy index; only renders are served
+        key, _, ext = name.partition(".")
+        if ext != "png" or len(key) != 64 or not all(c in "0123456789abcdef" for c in key):
+            return None
+        path = result_cache.path_for(key)
+    return path if path.is_file() else None
+
+def source_version(path: Path) -> str:
+    """Identifies the content of an image without reading it.
+
+    Images are only ever replaced by renaming a new file into place, never rewritten, so
+    the name and inode change together with the content. (Storage refreshes mtimes on
+    reads, so those can't be used.)
+    """
+    return f"{path.stem}:{path.stat().st_ino}"
+
+def render_derivative(source: str, destination: str, width: Optional[int], height: Optional[int],
+                      image_format: str, quality: int):
+    # Runs in a worker process
+    with Image.open(source) as img:
+        img.load()
+        if width or height:
+            img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+        if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        options = {}
+        if image_format == "jpeg":
+            options = {"quality": quality, "optimize": True, "progressive": True}
+        elif image_format in ("webp", "avif"):
+            options = {"quality": quality}
+        elif image_format == "png":
+            options = {"optimize": True}
+
+        tmp_path = destination + ".tmp"
+        img.save(tmp_path, format=image_format.upper(), **options)
+    os.replace(tmp_path, destination)
+
+async def get_derivative(source_path: Path, width: Optional[int], height: Optional[int],
+                         image_format: str, quality: int) -> Path:
+    version = source_version(source_path)
+    # PNG is lossless, so quality would only multiply identical renditions
+    params = f"{version}:{width}:{height}:{image_format}:{quality if image_format != 'png' else None}"
+    key = hashlib.sha256(params.encode()).hexdigest()
+    derivative_path = storage.path_for(key, image_format)
+    if derivative_path.exists():
+        CACHE_REQUESTS.inc("derivative", "hit")
+        storage.touch(derivative_path)
+        return derivative_path
+    CACHE_REQUESTS.inc("derivative", "miss")
+
+    async def render() -> Path:
+        staged_path = storage.temp_path(f".{image_format}")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            get_image_pool(), render_derivative,
+            str(source_path), str(staged_path), width, height, image_format, quality
+        )
+        return await asyncio.to_thread(storage.commit, staged_path, key, image_format)
+
+    return await single_flight.do(f"derivative:{key}", render)
+
+# Ingest stage for img2img uploads: SegmentAnything caps work at max_megapixels anyway,
+# so anything larger is only extra upload and upstream processing time
+INPUT_MAX_MEGAPIXELS = float(os.getenv("INPUT_MAX_MEGAPIXELS", "2"))
+INPUT_JPEG_QUALITY = int(os.getenv("INPUT_JPEG_QUALITY", "90"))
+
+def prepare_input_image(source: str, destination: str, max_megapixels: float, quality: int) -> tuple:
+    """Apply EXIF orientation, downscale to the megapixel budget and store as JPEG.
+
+    Runs in a worker process. Returns the final (width, height).
+    """
+    with Image.open(source) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        max_pixels = max_megapixels * 1_000_000
+        if img.format == "JPEG" and orientation == 1 and img.width * img.height <= max_pixels:
+            # Already what the workflow wants; keep the original bytes
+            size = img.size
+            shutil.copyfile(source, destination)
+            return size
+
+        if img.width * img.height > max_pixels:
+            # Let libjpeg decode at a reduced scale when it can; draft never goes below the target
+            scale = math.sqrt(max_pixels / (img.width * img.height))
+            img.draft("RGB", (int(img.width * scale), int(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+        if img.width * img.height > max_pixels:
+            scale = math.sqrt(max_pixels / (img.width * img.height))
+            img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        tmp_path = destination + ".tmp"
+        img.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, destination)
+        return img.size
+
+def read_image_size(path: str) -> tuple:
+    # Only parses the header, the pixel data is never decoded
+    with Image.open(path) as img:
+        return img.size
+
+# Local previews: once a room has been through the full workflow, its segmentation mask is
+# kept and other products are composited onto it locally, without a TensorArt job. The
+# workflow only returns the finished render, so the mask is recovered by diffing that
+# render against the input. Textures are turned into seamless multi-resolution tiles once.
+PREVIEW_TEXTURE_LEVELS = sorted(int(level) for level in split_list(os.getenv("PREVIEW_TEXTURE_LEVELS", "256,512,1024,2048")))
+PREVIEW_TILES_ACROSS = float(os.getenv("PREVIEW_TILES_ACROSS", "3"))
+PREVIEW_MASK_THRESHOLD = int(os.getenv("PREVIEW_MASK_THRESHOLD", "40"))
+PREVIEW_MASK_MIN_COVERAGE = float(os.getenv("PREVIEW_MASK_MIN_COVERAGE", "0.01"))
+PREVIEW_MASK_MAX_COVERAGE = float(os.getenv("PREVIEW_MASK_MAX_COVERAGE", "0.95"))
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "85"))
+PREVIEW_PRECOMPUTE = os.getenv("PREVIEW_PRECOMPUTE", "true").lower() in ("1", "true", "yes")
+
+def build_texture_pyramid(source: str, levels: List[tuple], quality: int):
+    """Write a seamless tile of source at each (width, destination) level.
+
+    Runs in a worker process.
+    """
+    largest = max(width for width, _ in levels)
+    with Image.open(source) as img:
+        # The tile is two slabs wide, so each slab only needs half the largest level
+        img.draft("RGB", (largest // 2, largest // 2))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((largest // 2, largest // 2), Image.LANCZOS)
+
+    # Mirroring the slab into a 2x2 block makes the tile wrap without seams both ways
+    tile = Image.new("RGB", (img.width * 2, img.height * 2))
+    tile.paste(img, (0, 0))
+    tile.paste(ImageOps.mirror(img), (img.width, 0))
+    tile.paste(ImageOps.flip(img), (0, img.height))
+    tile.paste(ImageOps.flip(ImageOps.mirror(img)), (img.width, img.height))
+
+    for width, destination in sorted(levels, reverse=True):
+        # Each level is resampled from the one above it
+        if width < tile.width:
+            tile = tile.resize((width, max(1, round(tile.height * width / tile.width))), Image.LANCZOS)
+        tmp_path = destination + ".tmp"
+        tile.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, destination)
+
+def extract_room_mask(room_path: str, render_path: str, destination: str, threshold: int) -> float:
+    """Mark the pixels the workflow changed and write them as a soft-edged L mask.
+
+    Runs in a worker process. Returns the fraction of the room the mask covers.
+    """
+    with Image.open(room_path) as img:
+        room = img.convert("RGB")
+    with Image.open(render_path) as img:
+        render = img.convert("RGB").resize(room.size, Image.BILINEAR)
+
+    # Compare at quarter resolution so JPEG noise and small shifts average out
+    small = (max(1, room.width // 4), max(1, room.height // 4))
+    before = np.asarray(room.resize(small, Image.BOX), dtype=np.int16)
+    after = np.asarray(render.resize(small, Image.BOX), dtype=np.int16)
+    changed = np.abs(before - after).max(axis=2) > threshold
+
+    mask = Image.fromarray(changed.astype(np.uint8) * 255, "L").filter(ImageFilter.MedianFilter(5))
+    mask = mask.resize(room.size, Image.BILINEAR).filter(ImageFilter.GaussianBlur(2))
+    tmp_path = destination + ".tmp"
+    mask.save(tmp_path, format="PNG")
+    os.replace(tmp_path, destination)
+    return float(np.asarray(mask, dtype=np.float32).mean() / 255)
+
+def render_preview(room_path: str, mask_path: str, texture_levels: List[tuple], destination: str,
+                   tiles_across: float, quality: int):
+    """Tile the texture over the masked surface, keeping the room's own shading.
+
+    Runs in a worker process.
+    """
+    with Image.open(room_path) as img:
+        room = np.asarray(img.convert("RGB"), dtype=np.float32)
+    height, width = room.shape[:2]
+    with Image.open(mask_path) as img:
+        mask = np.asarray(img.convert("L").resize((width, height), Image.BILINEAR), dtype=np.float32) / 255
+
+    # Smallest pyramid level that is still at least one tile wide
+    tile_width = max(1, round(width / tiles_across))
+    level_path = next((path for level, path in texture_levels if level >= tile_width), texture_levels[-1][1])
+    with Image.open(level_path) as img:
+        tile_height = max(1, round(img.height * tile_width / img.width))
+        tile = np.asarray(img.convert("RGB").resize((tile_width, tile_height), Image.BILINEAR), dtype=np.float32)
+    texture = np.tile(tile, (-(-height // tile_height), -(-width // tile_width), 1))[:height, :width]
+
+    # Light and shadow on the original surface carry over as a luminance ratio
+    luminance = room @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    surface_mean = float((luminance * mask).sum() / max(mask.sum(), 1.0))
+    shading = np.clip(luminance / max(surface_mean, 1.0), 0.4, 1.6)[..., None]
+    alpha = mask[..., None]
+    composite = room * (1 - alpha) + np.clip(texture * shading, 0, 255) * alpha
+
+    tmp_path = destination + ".tmp"
+    Image.fromarray(composite.astype(np.uint8), "RGB").save(tmp_path, format="JPEG", quality=quality, optimize=True)
+    os.replace(tmp_path, destination)
+
+def room_mask_key(room_digest: str, position: str) -> str:
+    return hashlib.sha256(f"mask:{room_digest}:{position.strip().lower()}".encode()).hexdigest()
+
+async def get_texture_pyramid(product: Product) -> List[tuple]:
+    """(width, path) for each level of the product's texture, building them on first use."""
+    levels = [
+        (width, storage.path_for(hashlib.sha256(f"texture:{product.sha256}:{width}".encode()).hexdigest(), "jpg"))
+        for width in PREVIEW_TEXTURE_LEVELS
+    ]
+    if all(path.exists() for _, path in levels):
+        CACHE_REQUESTS.inc("texture_pyramid", "hit")
+        return [(width, str(path)) for width, path in levels]
+    CACHE_REQUESTS.inc("texture_pyramid", "miss")
+
+    async def build() -> List[tuple]:
+        staged = [(width, storage.temp_path(".jpg")) for width, _ in levels]
+        loop = asyncio.get_running_loop()
+        with observe_stage("texture_pyramid"):
+            await loop.run_in_executor(
+                get_image_pool(), build_texture_pyramid,
+                str(product.image), [(width, str(path)) for width, path in staged], PREVIEW_JPEG_QUALITY
+            )
+        for (width, staged_path), (_, path) in zip(staged, levels):
+            await asyncio.to_thread(storage.commit, staged_path, path.stem, "jpg")
+        return [(width, str(path)) for width, path in levels]
+
+    return await single_flight.do(f"texture_pyramid:{product.sha256}", build)
+
+async def learn_room_mask(room_path: str, position: str, render_path: str):
+    """Keep the segmentation of a finished img2img render for later previews; best effort."""
+    key = room_mask_key(Path(room_path).stem, position)
+    if storage.path_for(key, "png").exists():
+        return
+    staged_path = storage.temp_path(".png")
+    try:
+        loop = asyncio.get_running_loop()
+        with observe_stage("extract_mask"):
+            coverage = await loop.run_in_executor(
+                get_image_pool(), extract_room_mask, room_path, render_path, str(staged_path), PREVIEW_MASK_THRESHOLD
+            )
+        if not PREVIEW_MASK_MIN_COVERAGE <= coverage <= PREVIEW_MASK_MAX_COVERAGE:
+            logger.info(f"Not keeping the mask for {position} in {Path(room_path).name}: covers {coverage:.0%}")
+            return
+        await asyncio.to_thread(storage.commit, staged_path, key, "png")
+        logger.info(f"Kept the {position} mask for {Path(room_path).name} ({coverage:.0%} of the room)")
+    except Exception as e:
+        logger.warning(f"Could not extract a mask from {render_path}: {str(e)}")
+    finally:
+        staged_path.unlink(missing_ok=True)
+
+async def get_preview(room_path: str, position: str, product: Product) -> Optional[Path]:
+    """Composite product onto the room locally, or None if the room has no mask yet."""
+    mask_path = storage.locate(f"{room_mask_key(Path(room_path).stem, position)}.png")
+    if mask_path is None:
+        return None
+    params = f"{Path(room_path).stem}:{position.strip().lower()}:{product.sha256}:{PREVIEW_TILES_ACROSS}:{PREVIEW_JPEG_QUALITY}"
+    key = hashlib.sha256(f"preview:{params}".encode()).hexdigest()
+    preview_path = storage.path_for(key, "jpg")
+    if preview_path.exists():
+        CACHE_REQUESTS.inc("preview", "hit")
+        storage.touch(preview_path)
+        return preview_path
+    CACHE_REQUESTS.inc("preview", "miss")
+
+    texture_levels = await get_texture_pyramid(product)
+
+    async def render() -> Path:
+        staged_path = storage.temp_path(".jpg")
+        loop = asyncio.get_running_loop()
+        with observe_stage("render_preview"):
+            await loop.run_in_executor(
+                get_image_pool(), render_preview,
+                room_path, str(mask_path), texture_levels, str(staged_path), PREVIEW_TILES_ACROSS, PREVIEW_JPEG_QUALITY
+            )
+        return await asyncio.to_thread(storage.commit, staged_path, key, "jpg")
+
+    return await single_flight.do(f"preview:{key}", render)
+
+async def precompute_texture_pyramids():
+    products = load_catalog().available()
+    for product in products:
+        try:
+            await get_texture_pyramid(product)
+        except Exception as e:
+            logger.error(f"Building the texture pyramid for {product.full_name} failed: {str(e)}")
+    logger.info(f"Texture pyramids ready for {len(products)} products")
+
+# Generation pipelines shared by the synchronous endpoints and the job workers
+async def save_upload(image: UploadFile) -> str:
+    upload_path = storage.temp_path(".upload")
+    staged_path = storage.temp_path(".jpg")
+    async with aiofiles.open(upload_path, "wb") as f:
+        while chunk := await image.read(STREAM_CHUNK_SIZE):
+            await f.write(chunk)
+
+    # Normalise the upload before it goes anywhere near TensorArt
+    loop = asyncio.get_running_loop()
+    try:
+        with observe_stage("ingest"):
+            width, height = await loop.run_in_executor(
+                get_image_pool(), prepare_input_image,
+                str(upload_path), str(staged_path), INPUT_MAX_MEGAPIXELS, INPUT_JPEG_QUALITY
+            )
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"Rejected img2img upload {image.filename}: {str(e)}")
+        staged_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="Uploaded file is not a supported image")
+    finally:
+        upload_path.unlink(missing_ok=True)
+
+    with observe_stage("save"):
+        image_path = await storage.store(staged_path, "jpg")
+
+    logger.info(f"Saved input image to {image_path} ({width}x{height})")
+    return str(image_path)
+
+def plan_text2img(request: GenerateRequest) -> tuple:
+    """Rewritten prompt, size and result cache key of a text2img request."""
+    width, height = parse_size(request.size_choice, request.custom_size)
+    # Rewrite prompt with Groq
+    rewritten_prompt = rewrite_prompt_with_groq(request.prompt, request.product_codes)
+    return rewritten_prompt, width, height, text2img_cache_key(rewritten_prompt, width, height, request.product_codes)
+
+async def find_text2img(request: GenerateRequest) -> Optional[str]:
+    """An earlier render of the same request, from the result cache or the journal."""
+    _, _, _, cache_key = plan_text2img(request)
+    cached_path = await result_cache.get(cache_key)
+    if cached_path:
+        logger.info(f"Result cache hit: {cache_key}")
+        return cached_path
+
+    flight_key = f"text2img:{cache_key}"
+    journaled_path = await journal.result(flight_key)
+    if journaled_path:
+        logger.info(f"Answering from the journal: {flight_key}")
+    return journaled_path
+
+async def reserve_text2img(request: GenerateRequest, client_id: str) -> bool:
+    """Reserve quota for the request unless an earlier render answers it; True if it did."""
+    if await find_text2img(request):
+        return False
+    admission.reserve(client_id)
+    return True
+
+async def generate_text2img(request: GenerateRequest, client_id: str = "anonymous", shed: bool = True) -> str:
+    found_path = await find_text2img(request)
+    if found_path:
+        return found_path
+
+    rewritten_prompt, width, height, cache_key = plan_text2img(request)
+    logger.info(f"Rewritten prompt: {rewritten_prompt}")
+    flight_key = f"text2img:{cache_key}"
+
+    async def produce() -> str:
+        # Generate image using txt2img function
+        save_path = result_cache.output_path(cache_key)
+        async with upstream_scheduler.slot(client_id, LANE_INTERACTIVE, shed=shed):
+            await txt2img(
+                rewritten_prompt, width, height, request.product_codes, save_path,
+                on_submit=functools.partial(journal.submitted, flight_key)
+            )
+        with observe_stage("save"):
+            await result_cache.put(cache_key, save_path)
+        return str(save_path)
+
+    async def generate() -> str:
+        params = {"prompt": rewritten_prompt, "width": width, "height": height,
+                  "product_codes": request.product_codes, "cache_key": cache_key, "client_id": client_id}
+        while not await journal.begin(flight_key, "text2img", params):
+            output_path = await journal.wait_for(flight_key, UPSTREAM_JOB_TIMEOUT * 2)
+            if output_path:
+                return output_path
+        return await journal.track(flight_key, produce())
+
+    return await single_flight.do(flight_key, generate)
+
+async def generate_img2img(image_path: str, request: Img2ImgRequest, client_id: str = "anonymous",
+                           shed: bool = True, uploaded_resource: Optional[str] = None) -> str:
+    """uploaded_resource is an upstream reference to the room image if the caller already uploaded it."""
+    async def produce() -> str:
+        image_size = await asyncio.to_thread(read_image_size, image_path)
+        uploaded = upstream_pool.resolve(uploaded_resource) if uploaded_resource else None
+        tried = set()
+        while True:
+            # Upload image to TensorArt unless the caller already did on a healthy endpoint
+            if uploaded is not None and uploaded[0].healthy and not tried:
+                endpoint, image_resource_id = uploaded
+            else:
+                endpoint, image_resource_id = upstream_pool.choose(exclude=tried), None
+            tried.add(endpoint.name)
+            try:
+                image_resource_id = image_resource_id or await upload_image_to_tensorart(image_path, endpoint)
+                if not image_resource_id:
+                    raise RuntimeError("Failed to upload input image.")
+
+                # Generate mask and apply texture
+                async with upstream_scheduler.slot(client_id, LANE_BATCH, shed=shed):
+                    output_path = await generate_mask(
+                        image_resource_id, request.position, request.product_codes[0], endpoint, image_size,
+                        on_submit=functools.partial(journal.submitted, flight_key)
+                    )
+                if output_path:
+                    await learn_room_mask(image_path, request.position, output_path)
+                return output_path
+            except UpstreamUnavailable as e:
+                if len(tried) >= len(upstream_pool.endpoints):
+                    raise RuntimeError(f"API request failed: {str(e)}")
+                upstream_pool.stats["failovers"] += 1
+                UPSTREAM_FAILOVERS.inc(endpoint.name, "workflow")
+                logger.warning(f"{str(e)}, moving the workflow to another endpoint")
+
+    async def generate() -> str:
+        params = {"image_path": image_path, "position": request.position,
+                  "product_code": request.product_codes[0], "client_id": client_id}
+        while not await journal.begin(flight_key, "img2img", params):
+            output_path = await journal.wait_for(flight_key, UPSTREAM_JOB_TIMEOUT * 2)
+            if output_path:
+                return output_path
+        return await journal.track(flight_key, produce())
+
+    image_digest = await asyncio.to_thread(file_sha256, image_path)
+    flight_key = img2img_flight_key(image_digest, request)
+    journaled_path = await journal.result(flight_key)
+    if journaled_path:
+        logger.info(f"Answering from the journal: {flight_key}")
+        return journaled_path
+    return await single_flight.do(flight_key, generate)
+
+def img2img_flight_key(image_digest: str, request: Img2ImgRequest) -> str:
+    return f"img2img:{image_digest}:{request.position.strip().lower()}:{request.product_codes[0]}"
+
+async def find_img2img(image_digest: str, request: Img2ImgRequest) -> Optional[str]:
+    """An earlier render of the same room, position and product, from the journal."""
+    return await journal.result(img2img_flight_key(image_digest, request))
+
+async def reserve_img2img(image_path: str, request: Img2ImgRequest, client_id: str) -> bool:
+    """Reserve quota for the request unless an earlier render answers it; True if it did."""
+    image_digest = await asyncio.to_thread(file_sha256, image_path)
+    if await find_img2img(image_digest, request):
+        return False
+    admission.reserve(client_id)
+    return True
+
+async def resume_generation(entry: dict) -> str:
+    """Finish an upstream job that was still running when the previous process stopped."""
+    params = entry["params"]
+    if entry["kind"] == "text2img":
+        save_path = result_cache.output_path(params["cache_key"])
+        async with upstream_scheduler.slot(params["client_id"], LANE_INTERACTIVE, shed=False, charge=False):
+            await finish_txt2img(entry["upstream_id"], save_path)
+        await result_cache.put(params["cache_key"], save_path)
+        return str(save_path)
+    async with upstream_scheduler.slot(params["client_id"], LANE_BATCH, shed=False, charge=False):
+        output_path = await finish_workflow(entry["upstream_id"])
+    await learn_room_mask(params["image_path"], params["position"], output_path)
+    return output_path
+
+# Job subsystem
+# Unfinished jobs this worker accepts; how many of them talk to TensorArt at once is up to the scheduler
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+BATCH_MAX_VARIANTS = int(os.getenv("BATCH_MAX_VARIANTS", "50"))
+
+JOB_MEDIA_TYPES = {"text2img": "image/png", "img2img": "image/jpeg"}
+JOB_REMOTE_POLL_INTERVAL = float(os.getenv("JOB_REMOTE_POLL_INTERVAL", "0.5"))
+JOB_EVENTS_KEEPALIVE = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))
+JOB_EVENTS_TIMEOUT = float(os.getenv("JOB_EVENTS_TIMEOUT", "900"))
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    params: dict
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result_path: Optional[str] = None
+    error: Optional[str] = None
+    stage: Optional[str] = None
+    progress: dict = field(default_factory=dict)
+    request_id: str = field(default_factory=request_id_var.get)
+    client_id: str = ""
+    owner: str = WORKER_ID
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    @property
+    def is_local(self) -> bool:
+        return self.owner == WORKER_ID
+
+    @property
+    def media_type(self) -> str:
+        return JOB_MEDIA_TYPES[self.kind]
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "stage": self.stage,
+            "progress": self.progress,
+        }
+        if self.status == "succeeded":
+            data["result_url"] = f"/api/jobs/{self.id}/result"
+            data["image_url"] = f"/api/images/{Path(self.result_path).name}"
+        return data
+
+    def to_record(self) -> dict:
+        return {**self.to_dict(), "result_path": self.result_path, "request_id": self.request_id,
+                "client_id": self.client_id, "owner": self.owner}
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        """Read-only view of a job that runs on another worker."""
+        return cls(
+            id=record["job_id"], kind=record["kind"], params={}, status=record["status"],
+            created_at=record["created_at"], started_at=record["started_at"],
+            finished_at=record["finished_at"], result_path=record["result_path"],
+            error=record["error"], stage=record.get("stage"), progress=record.get("progress") or {},
+            request_id=record["request_id"], client_id=record.get("client_id", ""), owner=record["owner"]
+        )
+
+    def notify(self):
+        """Wake everyone watching this job; each watcher re-arms on the fresh event."""
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class JobManager:
+    """Job table with one task per accepted job, up to max_active unfinished jobs.
+
+    The tasks queue for the upstream scheduler, which alone decides how many run at once
+    and in which order between clients. Jobs run on the worker that accepted them; their
+    records are mirrored to shared state so any worker can report status, serve results
+    and forward cancellations.
+    """
+
+    namespace = "jobs"
+
+    def __init__(self, max_active: int, ttl: int, state: SharedState):
+        self.max_active = max_active
+        self.ttl = ttl
+        self.state = state
+        self.jobs: Dict[str, Job] = {}
+        self.active = 0
+        self._feeds: Dict[str, "RemoteJobFeed"] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._watch_task = asyncio.create_task(self._watch_cancellations())
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+    def submit(self, kind: str, params: dict) -> Job:
+        self._prune()
+        if not self.has_capacity(1):
+            raise asyncio.QueueFull()
+        job = Job(id=uuid.uuid4().hex, kind=kind, params=params, client_id=params["client_id"])
+        self.jobs[job.id] = job
+        self.active += 1
+        job.task = asyncio.create_task(self._run(job))
+        job.task.add_done_callback(functools.partial(self._settle, job))
+        self._publish(job)
+        logger.info(f"Queued {kind} job {job.id}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    async def lookup(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        record = await self.state.get(self.namespace, job_id)
+        if record is None:
+            return None
+        job = Job.from_record(record)
+        if not job.is_finished and job.owner not in await self.state.live_workers():
+            # Resubmitting is cheap: the upstream generation itself is adopted through the journal
+            job.status = "failed"
+            job.error = "The worker running this job stopped, please resubmit"
+        return job
+
+    async def wait(self, job: Job, timeout: float) -> Job:
+        """Wait up to timeout seconds for the job to finish and return its latest state."""
+        if job.is_local:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            return job
+        deadline = time.time() + timeout
+        with self._follow(job) as feed:
+            while not feed.job.is_finished and time.time() < deadline:
+                await feed.changed_within(deadline - time.time())
+            return feed.job
+
+    async def watch(self, job: Job, seen: dict, timeout: float) -> Job:
+        """Wait up to timeout seconds for the job to differ from seen and return its latest state."""
+        if job.is_local:
+            if job.to_dict() == seen:
+                try:
+                    await asyncio.wait_for(job.changed.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return job
+        with self._follow(job) as feed:
+            if feed.job.to_dict() == seen:
+                await feed.changed_within(timeout)
+            return feed.job
+
+    @contextmanager
+    def _follow(self, job: Job):
+        """Share one poller per remote job between everyone waiting on it."""
+        feed = self._feeds.get(job.id)
+        if feed is None:
+            feed = self._feeds[job.id] = RemoteJobFeed(self, job)
+        feed.listeners += 1
+        try:
+            yield feed
+        finally:
+            feed.listeners -= 1
+
+    def has_capacity(self, count: int) -> bool:
+        return self.max_active <= 0 or self.max_active - self.active >= count
+
+    async def cancel(self, job: Job) -> bool:
+        """False if the job finished or its generation already went upstream and can't be called off."""
+        if job.is_finished:
+            return False
+        if not job.is_local:
+            # The owning worker picks this up from shared state
+            await self.state.set("job_cancellations", job.id, {"requested_at": time.time()}, ttl=self.ttl)
+            return True
+        task = job.task
+        if not single_flight.cancellable(task):
+            return False
+        task.cancel()
+        # Settles the job before returning, so callers report its final state
+        await asyncio.wait([task])
+        return True
+
+    async def _watch_cancellations(self):
+        while True:
+            await asyncio.sleep(JOB_REMOTE_POLL_INTERVAL * 2)
+            try:
+                requested = await self.state.items("job_cancellations")
+                for job_id in requested:
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        await self.state.delete("job_cancellations", job_id)
+                        await self.cancel(job)
+            except Exception as e:
+                logger.error(f"Checking job cancellations failed: {str(e)}")
+
+    def _settle(self, job: Job, task: asyncio.Task):
+        if task.cancelled():
+            self._finish(job, "cancelled")
+        elif task.exception() is not None:
+            error = task.exception()
+            logger.error(f"Job {job.id} failed: {error}")
+            self._finish(job, "failed", error=str(error))
+        else:
+            self._finish(job, "succeeded", result_path=task.result())
+
+    async def _run(self, job: Job) -> str:
+        job.status = "running"
+        job.started_at = time.time()
+        self._publish(job)
+        job.notify()
+        request_id_var.set(job.request_id)
+        progress_var.set(lambda stage, detail: self._progress(job, stage, detail))
+        # Jobs were admitted at submit time, so they wait for an upstream slot instead of being shed
+        client_id = job.params["client_id"]
+        if job.kind == "text2img":
+            return await generate_text2img(job.params["request"], client_id, shed=False)
+        return await generate_img2img(
+            job.params["image_path"], job.params["request"], client_id,
+            shed=False, uploaded_resource=job.params.get("image_resource")
+        )
+
+    def _finish(self, job: Job, status: str, result_path: Optional[str] = None, error: Optional[str] = None):
+        job.status = status
+        job.result_path = result_path
+        job.error = error
+        job.finished_at = time.time()
+        job.task = None
+        self.active -= 1
+        if job.params.get("reserved"):
+            admission.release(job.params["client_id"])
+        job.done.set()
+        self._publish(job)
+        job.notify()
+        logger.info(f"Job {job.id} {status}")
+
+    def _progress(self, job: Job, stage: str, detail: dict):
+        if job.is_finished or (job.stage, job.progress) == (stage, detail):
+            return
+        job.stage = stage
+        job.progress = detail
+        self._publish(job)
+        job.notify()
+
+    def _publish(self, job: Job):
+        # Unfinished jobs also expire, in case this worker dies before finishing them
+        self.state.publish(self.namespace, job.id, job.to_record(), ttl=self.ttl if job.is_finished else self.ttl * 2)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self.jobs.items() if job.is_finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+class RemoteJobFeed:
+    """Latest state of a job running on another worker, polled while anyone is listening."""
+
+    def __init__(self, manager: JobManager, job: Job):
+        self.manager = manager
+        self.job = job
+        self.listeners = 0
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._poll())
+
+    async def changed_within(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout=max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll(self):
+        try:
+            while self.listeners and not self.job.is_finished:
+                await asyncio.sleep(JOB_REMOTE_POLL_INTERVAL)
+                try:
+                    latest = await self.manager.lookup(self.job.id)
+                except Exception as e:
+                    logger.error(f"Polling job {self.job.id} failed: {str(e)}")
+                    continue
+                if latest is not None and latest.to_dict() != self.job.to_dict():
+                    self.job = latest
+                    changed, self.changed = self.changed, asyncio.Event()
+                    changed.set()
+        finally:
+            del self.manager._feeds[self.job.id]
+
+job_manager = JobManager(JOB_QUEUE_SIZE, JOB_TTL, shared_state)
+
+metrics.register(Gauge("casla_jobs_queued", "Jobs waiting for an upstream slot",
+                       lambda: sum(1 for job in job_manager.jobs.values()
+                                   if not job.is_finished and job.stage == "queued")))
+metrics.register(Gauge("casla_jobs_running", "Jobs currently running",
+                       lambda: sum(1 for job in job_manager.jobs.values()
+                                   if job.status == "running" and job.stage != "queued")))
+metrics.register(Gauge("casla_upstream_requests_in_flight", "Open HTTP requests to TensorArt",
+                       lambda: upstream_client.stats["in_flight"]))
+metrics.register(Gauge("casla_single_flight_in_flight", "Coalesced calls in progress",
+                       lambda: single_flight.in_flight()))
+
+def submit_job(kind: str, params: dict) -> Job:
+    """Queue a job; if params["reserved"], it holds a quota reservation it releases when it finishes."""
+    try:
+        return job_manager.submit(kind, params)
+    except asyncio.QueueFull:
+        if params.get("reserved"):
+            admission.release(params["client_id"])
+        raise HTTPException(
+            status_code=429,
+            detail="Job queue is full, please retry later",
+            headers={"Retry-After": str(upstream_scheduler.retry_after())}
+        )
+
+def describe_new_job(job: Job) -> dict:
+    # EventSource cannot set headers, so the events URL carries a token scoped to this job
+    token = admission.job_token(job.client_id, job.id, JOB_TTL * 2)
+    return {**job.to_dict(), "events_url": f"/api/jobs/{job.id}/events?token={token}"}
+
+async def get_job_or_404(job_id: str, client_id: str) -> Job:
+    job = await job_manager.lookup(job_id)
+    # Other clients' jobs are reported as missing, so job IDs can't be probed
+    if job is None or not admission.owns(client_id, job.client_id):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@app.on_event("startup")
+async def load_product_catalog():
+    # Off the event loop, so neither startup nor the first request pays for the file checks
+    catalog = await asyncio.to_thread(load_catalog)
+    for problem in catalog.problems:
+        logger.warning(f"Product catalog: {problem}")
+    logger.info(f"Loaded {len(catalog.products)} products, {len(catalog.available())} with textures")
+
+@app.on_event("startup")
+async def start_texture_pyramids():
+    if PREVIEW_PRECOMPUTE:
+        app.state.texture_pyramids = asyncio.create_task(precompute_texture_pyramids())
+
+@app.on_event("shutdown")
+async def stop_texture_pyramids():
+    task = getattr(app.state, "texture_pyramids", None)
+    if task is not None:
+        task.cancel()
+
+@app.on_event("startup")
+async def start_job_workers():
+    await job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_manager.stop()
+
+@app.on_event("startup")
+async def start_journal():
+    await journal.start(resume_generation)
+
+@app.on_event("shutdown")
+async def stop_journal():
+    await journal.stop()
+
+@app.on_event("startup")
+async def start_texture_registry():
+    await texture_registry.start(warmup=TEXTURE_WARMUP)
+
+@app.on_event("shutdown")
+async def stop_texture_registry():
+    await texture_registry.stop()
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    await upstream_client.aclose()
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    app.state.loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_event_loop_monitor():
+    app.state.loop_monitor.cancel()
+
+@app.on_event("startup")
+async def start_storage_cleanup():
+    await storage.start()
+
+@app.on_event("shutdown")
+async def stop_storage_cleanup():
+    await storage.stop()
+
+@app.on_event("startup")
+async def start_image_pool():
+    # Fork the workers before uvicorn binds its socket; otherwise they inherit it and, if this
+    # process is killed, keep the port busy so the restarted service cannot bind
+    await asyncio.get_running_loop().run_in_executor(get_image_pool(), os.getpid)
+
+@app.on_event("shutdown")
+async def stop_image_pool():
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("startup")
+async def start_shared_state():
+    await shared_state.start()
+    await result_cache.import_legacy_index()
+    await result_cache.start()
+
+@app.on_event("shutdown")
+async def stop_shared_state():
+    await result_cache.stop()
+    await shared_state.stop()
+
+@app.on_event("startup")
+async def start_admission():
+    await admission.start()
+
+@app.on_event("shutdown")
+async def stop_admission():
+    await admission.stop()
+
+# TensorArt workflow completion callback (runningNotifyUrl)
+@app.post("/api/tensorart/callback", summary="TensorArt workflow notification", include_in_schema=False)
+async def tensorart_callback(request: Request, token: str = Query("")):
+    if WEBHOOK_SECRET and token != WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="Invalid callback token")
+    if not isinstance(workflow_completion, WebhookCompletion):
+        return {"status": "ignored"}
+
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+
+    upstream_id = data.get("workflowId") or data.get("taskId") or data.get("id")
+    woken = bool(upstream_id) and workflow_completion.notify(str(upstream_id))
+    logger.info(f"TensorArt callback for {upstream_id}: {data.get('status')} (waiter found: {woken})")
+    return {"status": "ok"}
+
+@app.get("/api/upstream/stats", summary="Upstream connection pool statistics",
+         dependencies=[Depends(verify_ops_access)])
+async def upstream_stats():
+    return {
+        **upstream_client.pool_stats(),
+        "pool": upstream_pool.describe(),
+        "scheduler": upstream_scheduler.stats(),
+        "single_flight": {**single_flight.stats, "in_flight": single_flight.in_flight()},
+    }
+
+@app.get("/api/usage", summary="The calling client's usage today and its limits")
+async def client_usage(client_id: str = Depends(get_client_id)):
+    return admission.describe(client_id)
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse, include_in_schema=False,
+         dependencies=[Depends(verify_ops_access)])
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/storage/stats", summary="Storage usage as of the last cleanup pass",
+         dependencies=[Depends(verify_ops_access)])
+async def storage_stats():
+    return {**storage.stats, "max_bytes": storage.max_bytes, "ttl": storage.ttl}
+
+@app.get("/api/journal/stats", summary="Generation journal entries by status",
+         dependencies=[Depends(verify_ops_access)])
+async def journal_stats():
+    return await asyncio.to_thread(journal.stats)
+
+@app.get("/api/products", summary="Product catalog")
+async def list_products():
+    catalog = load_catalog()
+    return {"products": [product.describe() for product in catalog.products], "problems": catalog.problems}
+
 # Health check endpoint
 @app.get("/api/health", summary="Health check endpoint")
 async def health_check():
-    return {"status": "ok", "timestamp": time.time()}
+    return {"status": "ok", "worker": WORKER_ID, "timestamp": time.time()}
+
+# SPA fallback; registered last so it never shadows the GET API routes above
+@app.get("/{path:path}", include_in_schema=False)
+async def serve_frontend(path: str):
+    if path == "api" or path.startswith("api/"):
+        # Unknown API paths are errors, not pages
+        raise HTTPException(status_code=404, detail="Not Found")
+    index_path = FRONTEND_BUILD_DIR / "index.html"
+    if not index_path.is_file():
+        raise HTTPException(status_code=404, detail="Frontend is not built")
+    return FileResponse(str(index_path))
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
     
-    # Add sample product mapping for testing
-    PRODUCT_IMAGE_MAP = {
-        "C1012 Glacier White": "product_images/C1012.jpg",
-        "C1026 Polar": "product_images/C1026.jpg",
-        "C3269 Ash Grey": "product_images/C3269.jpg",
-        "C3168 Silver Wave": "product_images/C3168.jpg",
-        "C1005 Milky White": "product_images/C1005.jpg",
-        "C2103 Onyx Carrara": "product_images/C2103.jpg",
-        "C2104 Massa": "product_images/C2104.jpg",
-        "C3105 Casla Cloudy": "product_images/C3105.jpg",
-        "C3146 Casla Nova": "product_images/C3146.jpg",
-        "C2240 Marquin": "product_images/C2240.jpg",
-        "C2262 Concrete (Honed)": "product_images/C2262.jpg",
-        "C3311 Calacatta Sky": "product_images/C3311.jpg",
-        "C3346 Massimo": "product_images/C3346.jpg",
-        "C4143 Mario": "product_images/C4143.jpg",
-        "C4145 Marina": "product_images/C4145.jpg",
-        "C4202 Calacatta Gold": "product_images/C4202.jpg",
-        "C1205 Casla Everest": "product_images/C1205.jpg",
-        "C4211 Calacatta Supreme": "product_images/C4211.jpg",
-        "C4204 Calacatta Classic": "product_images/C4204.jpg",
-        "C1102 Super White": "product_images/C1102.jpg",
-        "C4246 Casla Mystery": "product_images/C4246.jpg",
-        "C4345 Oro": "product_images/C4345.jpg",
-        "C4346 Luxe": "product_images/C4346.jpg",
-        "C4342 Casla Eternal": "product_images/C4342.jpg",
-        "C4221 Athena": "product_images/C4221.jpg",
-        "C4255 Calacatta Extra": "product_images/C4255.jpg",
-    }
-    
-    # Create sample texture directory
-    Path("./textures").mkdir(exist_ok=True)
-    
-    # Run the server
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Casla Quartz API")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="worker processes (WEB_CONCURRENCY)")
+    parser.add_argument("--reload", action="store_true", help="development mode: one worker, restart on code changes")
+    parser.add_argument("--write-catalog", action="store_true",
+                        help="recompute texture sizes, hashes and dimensions into the catalog manifest and exit")
+    args = parser.parse_args()
+
+    if args.write_catalog:
+        catalog = load_catalog()
+        catalog.validate(refresh=True)
+        catalog.write()
+        for problem in catalog.problems:
+            print(problem)
+        print(f"Wrote {len(catalog.products)} products to {catalog.manifest_path}")
+        raise SystemExit(0)
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    if args.reload:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True, app_dir=app_dir)
+    else:
+        # Workers read WEB_CONCURRENCY to split deployment-wide limits between them
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, app_dir=app_dir)
\ No newline at end of file
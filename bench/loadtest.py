@@ -0,0 +1,202 @@
+"""Drive the API at a fixed concurrency and report latency, throughput and server health.
+
+Start the mock upstream and the API first (see mock_tensorart.py), then:
+
+    python bench/loadtest.py --endpoint text2img --concurrency 32 --requests 256
+    python bench/loadtest.py --endpoint img2img --image room.jpg --concurrency 8 --requests 64
+
+By default every text2img request carries a distinct prompt so the result cache and
+single-flight collapse don't hide upstream work; pass --repeat-prompts to measure them.
+The API's /metrics endpoint is scraped before and after the run for event-loop lag and
+resident memory, with --ops-token if the API sets OPS_TOKEN and --api-key otherwise.
+--json prints a machine-readable summary for comparing runs.
+
+All requests come from one client, so start the API with CLIENT_RATE_LIMIT=0 and
+CLIENT_DAILY_JOBS=0 unless admission control is what is being measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_PRODUCT_CODES = "C1012 Glacier White"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """Pick the samples we report on out of the Prometheus text exposition."""
+    wanted = (
+        "casla_event_loop_lag_seconds_sum",
+        "casla_event_loop_lag_seconds_count",
+        "casla_process_resident_memory_bytes",
+        "casla_jobs_queued",
+    )
+    samples = {}
+    lag_max = 0.0
+    for line in text.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        name, _, value = line.rpartition(" ")
+        if name in wanted:
+            samples[name] = float(value)
+        match = re.match(r'casla_event_loop_lag_seconds_bucket\{le="([^"]+)"\}', name)
+        if match and match.group(1) != "+Inf":
+            samples.setdefault("lag_buckets", []).append((float(match.group(1)), float(value)))
+    buckets = samples.pop("lag_buckets", [])
+    count = samples.get("casla_event_loop_lag_seconds_count", 0)
+    # Smallest bucket that holds every observation bounds the worst lag seen
+    for bound, cumulative in sorted(buckets):
+        if cumulative >= count:
+            lag_max = bound
+            break
+    else:
+        lag_max = float("inf") if count else 0.0
+    samples["event_loop_lag_max_le"] = lag_max
+    return samples
+
+
+async def scrape_metrics(client: httpx.AsyncClient, ops_token: Optional[str]) -> Dict[str, float]:
+    headers = {"Authorization": f"Bearer {ops_token}"} if ops_token else {}
+    try:
+        response = await client.get("/metrics", headers=headers)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"warning: could not scrape /metrics: {e}", file=sys.stderr)
+        return {}
+    return parse_metrics(response.text)
+
+
+async def call_text2img(client: httpx.AsyncClient, args, index: int) -> httpx.Response:
+    prompt = args.prompt if args.repeat_prompts else f"{args.prompt} #{index} {uuid.uuid4().hex[:8]}"
+    payload = {"prompt": prompt, "size_choice": args.size, "product_codes": args.product_codes.split(",")}
+    return await client.post("/api/text2img", json=payload)
+
+
+async def call_img2img(client: httpx.AsyncClient, args, index: int) -> httpx.Response:
+    files = {"image": (os.path.basename(args.image), args.image_bytes, "image/jpeg")}
+    params = {"position": args.position, "size_choice": args.size}
+    data = {"product_codes": args.product_codes.split(",")}
+    return await client.post("/api/img2img", params=params, files=files, data=data)
+
+
+async def run(args) -> dict:
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    endpoints = ["text2img", "img2img"] if args.endpoint == "both" else [args.endpoint]
+    calls = {"text2img": call_text2img, "img2img": call_img2img}
+
+    latencies: Dict[str, List[float]] = {name: [] for name in endpoints}
+    statuses: Dict[str, Counter] = {name: Counter() for name in endpoints}
+    counter = iter(range(args.requests))
+
+    async with httpx.AsyncClient(base_url=args.base_url, headers=headers, timeout=timeout, limits=limits) as client:
+        before = await scrape_metrics(client, args.ops_token)
+
+        async def worker():
+            for index in counter:
+                name = endpoints[index % len(endpoints)]
+                started = time.perf_counter()
+                try:
+                    response = await calls[name](client, args, index)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - started
+                statuses[name][status] += 1
+                if status == "200":
+                    latencies[name].append(elapsed)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - started
+
+        after = await scrape_metrics(client, args.ops_token)
+
+    report = {"concurrency": args.concurrency, "requests": args.requests, "wall_seconds": round(wall, 3), "endpoints": {}}
+    for name in endpoints:
+        ok = latencies[name]
+        report["endpoints"][name] = {
+            "ok": len(ok),
+            "statuses": dict(statuses[name]),
+            "throughput_rps": round(len(ok) / wall, 3) if wall else 0.0,
+            "p50": round(percentile(ok, 50), 3),
+            "p95": round(percentile(ok, 95), 3),
+            "p99": round(percentile(ok, 99), 3),
+            "max": round(max(ok), 3) if ok else 0.0,
+        }
+
+    lag_count = after.get("casla_event_loop_lag_seconds_count", 0) - before.get("casla_event_loop_lag_seconds_count", 0)
+    lag_sum = after.get("casla_event_loop_lag_seconds_sum", 0) - before.get("casla_event_loop_lag_seconds_sum", 0)
+    report["server"] = {
+        "event_loop_lag_mean": round(lag_sum / lag_count, 4) if lag_count else None,
+        "event_loop_lag_max_le": after.get("event_loop_lag_max_le"),
+        "rss_before_mb": round(before.get("casla_process_resident_memory_bytes", 0) / 2**20, 1),
+        "rss_after_mb": round(after.get("casla_process_resident_memory_bytes", 0) / 2**20, 1),
+    }
+    return report
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests at concurrency {report['concurrency']} in {report['wall_seconds']}s")
+    for name, stats in report["endpoints"].items():
+        statuses = ", ".join(f"{code}: {count}" for code, count in sorted(stats["statuses"].items()))
+        print(f"  {name}: {stats['ok']} ok ({statuses})")
+        print(f"    throughput {stats['throughput_rps']} req/s")
+        print(f"    latency p50 {stats['p50']}s  p95 {stats['p95']}s  p99 {stats['p99']}s  max {stats['max']}s")
+    server = report["server"]
+    print(f"  event loop lag: mean {server['event_loop_lag_mean']}s, worst <= {server['event_loop_lag_max_le']}s")
+    print(f"  resident memory: {server['rss_before_mb']} MB -> {server['rss_after_mb']} MB")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default=os.getenv("BENCH_BASE_URL", "http://localhost:8000"))
+    parser.add_argument("--api-key", default=os.getenv("BENCH_API_KEY"))
+    parser.add_argument("--ops-token", default=os.getenv("BENCH_OPS_TOKEN"), help="OPS_TOKEN of the API, for /metrics")
+    parser.add_argument("--endpoint", choices=["text2img", "img2img", "both"], default="text2img")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--prompt", default="modern living room with tiled floor")
+    parser.add_argument("--repeat-prompts", action="store_true", help="send the same prompt every time")
+    parser.add_argument("--size", default="1024x768")
+    parser.add_argument("--product-codes", default=DEFAULT_PRODUCT_CODES, help="comma separated")
+    parser.add_argument("--position", default="floor")
+    parser.add_argument("--image", help="room photo to upload for img2img")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.endpoint in ("img2img", "both"):
+        if not args.image:
+            parser.error("--image is required for img2img")
+        with open(args.image, "rb") as f:
+            args.image_bytes = f.read()
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Local stand-in for the TensorArt API, for benchmarks that must not spend real money.
+
+Implements the endpoints app/main.py talks to: /jobs, /jobs/{id}, /resource/image,
+the presigned PUT, /workflow/run and /workflow/status/{id}, plus the image downloads.
+
+Run it and point the API at it:
+
+    MOCK_JOB_SECONDS=5 uvicorn mock_tensorart:app --app-dir bench --port 9000
+    URL_PRE=http://localhost:9000 API_KEY_TOKEN=bench uvicorn main:app --app-dir app
+
+Behaviour is tuned with environment variables:
+
+    MOCK_LATENCY          seconds added to every API response (default 0.05)
+    MOCK_JOB_SECONDS      how long a txt2img job or workflow runs (default 5)
+    MOCK_JOB_JITTER       +/- random fraction applied to MOCK_JOB_SECONDS (default 0.2)
+    MOCK_QUEUE_SECONDS    how long a job reports QUEUED before it starts running (default 0)
+    MOCK_FAILURE_RATE     fraction of jobs/workflows that end FAILED (default 0)
+    MOCK_ERROR_RATE       fraction of API calls answered with an error (default 0)
+    MOCK_ERROR_STATUS     status code of those errors, e.g. 429 for rate limiting (default 503)
+    MOCK_IMAGE_SIZE       WxH of the generated images (default 1024x768)
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+from io import BytesIO
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+from PIL import Image
+
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0.05"))
+MOCK_JOB_SECONDS = float(os.getenv("MOCK_JOB_SECONDS", "5"))
+MOCK_JOB_JITTER = float(os.getenv("MOCK_JOB_JITTER", "0.2"))
+MOCK_QUEUE_SECONDS = float(os.getenv("MOCK_QUEUE_SECONDS", "0"))
+MOCK_FAILURE_RATE = float(os.getenv("MOCK_FAILURE_RATE", "0"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_ERROR_STATUS = int(os.getenv("MOCK_ERROR_STATUS", "503"))
+MOCK_IMAGE_SIZE = tuple(int(v) for v in os.getenv("MOCK_IMAGE_SIZE", "1024x768").split("x"))
+
+app = FastAPI(title="Mock TensorArt API")
+ids = itertools.count(1)
+tasks = {}
+stats = {"jobs": 0, "workflows": 0, "uploads": 0, "upload_bytes": 0, "errors": 0}
+
+
+def render_image(image_format: str) -> bytes:
+    # Noise compresses badly, which keeps payload sizes close to real renders
+    width, height = MOCK_IMAGE_SIZE
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+IMAGES = {"png": render_image("PNG"), "jpg": render_image("JPEG")}
+
+
+async def simulate_call():
+    await asyncio.sleep(MOCK_LATENCY)
+    if random.random() < MOCK_ERROR_RATE:
+        stats["errors"] += 1
+        raise HTTPException(status_code=MOCK_ERROR_STATUS, detail="Mock upstream unavailable")
+
+
+def start_task(kind: str, notify_url: str = "") -> str:
+    task_id = f"{kind}-{next(ids)}"
+    duration = MOCK_QUEUE_SECONDS + MOCK_JOB_SECONDS * (1 + random.uniform(-MOCK_JOB_JITTER, MOCK_JOB_JITTER))
+    tasks[task_id] = {
+        "start_at": time.time() + MOCK_QUEUE_SECONDS,
+        "finish_at": time.time() + duration,
+        "failed": random.random() < MOCK_FAILURE_RATE,
+    }
+    if notify_url:
+        asyncio.create_task(notify(notify_url, task_id, duration))
+    return task_id
+
+
+async def notify(url: str, task_id: str, delay: float):
+    await asyncio.sleep(delay)
+    status = "FAILED" if tasks[task_id]["failed"] else "COMPLETED"
+    async with httpx.AsyncClient() as client:
+        try:
+            await client.post(url, json={"workflowId": task_id, "status": status})
+        except httpx.HTTPError:
+            pass
+
+
+def task_state(task_id: str) -> dict:
+    task = tasks.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task {task_id}")
+    return task
+
+
+@app.post("/jobs")
+async def create_job(request: Request):
+    await simulate_call()
+    await request.json()
+    stats["jobs"] += 1
+    return {"job": {"id": start_task("job"), "status": "WAITING"}}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    await simulate_call()
+    task = task_state(job_id)
+    if time.time() < task["start_at"]:
+        return {"job": {"id": job_id, "status": "QUEUED"}}
+    if time.time() < task["finish_at"]:
+        return {"job": {"id": job_id, "status": "RUNNING"}}
+    if task["failed"]:
+        return {"job": {"id": job_id, "status": "FAILED", "failureInfo": {"message": "Mock failure"}}}
+    image_url = f"{request.base_url}files/{job_id}.png"
+    return {"job": {"id": job_id, "status": "SUCCESS", "successInfo": {"images": [{"url": image_url}]}}}
+
+
+@app.post("/resource/image")
+async def create_resource(request: Request):
+    await simulate_call()
+    resource_id = f"resource-{next(ids)}"
+    return {
+        "resourceId": resource_id,
+        "putUrl": f"{request.base_url}upload/{resource_id}",
+        "headers": {"Content-Type": "image/jpeg"},
+    }
+
+
+@app.put("/upload/{resource_id}")
+async def upload_resource(resource_id: str, request: Request):
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    stats["uploads"] += 1
+    stats["upload_bytes"] += size
+    return Response(status_code=200)
+
+
+@app.post("/workflow/run")
+async def run_workflow(request: Request):
+    await simulate_call()
+    payload = await request.json()
+    stats["workflows"] += 1
+    return {"workflowId": start_task("workflow", payload.get("runningNotifyUrl", ""))}
+
+
+@app.get("/workflow/status/{workflow_id}")
+async def workflow_status(workflow_id: str, request: Request):
+    await simulate_call()
+    task = task_state(workflow_id)
+    if time.time() < task["start_at"]:
+        return {"status": "QUEUED"}
+    if time.time() < task["finish_at"]:
+        return {"status": "RUNNING"}
+    if task["failed"]:
+        return {"status": "FAILED", "errorMessage": "Mock failure"}
+    return {"status": "COMPLETED", "outputUrl": f"{request.base_url}files/{workflow_id}.jpg"}
+
+
+@app.get("/files/{name}")
+async def download(name: str):
+    extension = name.rsplit(".", 1)[-1]
+    if extension not in IMAGES:
+        raise HTTPException(status_code=404, detail="Unknown file")
+    media_type = "image/png" if extension == "png" else "image/jpeg"
+    return Response(IMAGES[extension], media_type=media_type)
+
+
+@app.get("/stats")
+async def mock_stats():
+    return stats
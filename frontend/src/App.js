@@ -4,6 +4,41 @@ import Dropzone from 'react-dropzone';
 import './App.css';
 
 const API_URL = '/api';
+const API_KEY = 'YOUR_API_KEY_HERE'; // Thay bằng API key thực tế
+
+// Tên hiển thị cho các bước xử lý mà server gửi qua /api/jobs/{id}/events
+const STAGE_LABELS = {
+  queued: 'Đang chờ đến lượt...',
+  uploading: 'Đang tải ảnh lên...',
+  submitting: 'Đang gửi yêu cầu...',
+  queued_upstream: 'Đang chờ máy chủ tạo ảnh...',
+  running: 'Đang tạo ảnh...',
+  downloading: 'Đang tải kết quả...'
+};
+
+// Theo dõi job qua Server-Sent Events, trả về URL ảnh khi job hoàn tất
+const waitForJob = (eventsUrl, onStage) => new Promise((resolve, reject) => {
+  // EventSource không gửi được header; events_url do server trả về đã kèm token chỉ dùng được cho job này
+  const source = new EventSource(eventsUrl);
+  source.addEventListener('progress', (event) => {
+    const job = JSON.parse(event.data);
+    onStage(STAGE_LABELS[job.stage] || 'Đang xử lý...');
+  });
+  source.addEventListener('succeeded', (event) => {
+    source.close();
+    resolve(JSON.parse(event.data).image_url);
+  });
+  ['failed', 'cancelled'].forEach((name) => source.addEventListener(name, (event) => {
+    source.close();
+    reject(new Error(JSON.parse(event.data).error || 'Job đã bị hủy'));
+  }));
+  source.onerror = () => {
+    // EventSource tự kết nối lại; chỉ dừng khi trình duyệt đã bỏ cuộc
+    if (source.readyState === EventSource.CLOSED) {
+      reject(new Error('Mất kết nối tới máy chủ'));
+    }
+  };
+});
 
 function App() {
   const [activeTab, setActiveTab] = useState('text2img'); // Mặc định hiển thị "Tạo ảnh từ văn bản"
@@ -16,6 +51,7 @@ function App() {
   const [position, setPosition] = useState('');
   const [generatedImage, setGeneratedImage] = useState(null);
   const [loading, setLoading] = useState(false);
+  const [stage, setStage] = useState('');
 
   const productOptions = [
     "C1012 Glacier White", "C1026 Polar", "C3269 Ash Grey",
@@ -47,10 +83,12 @@ function App() {
       alert('Vui lòng nhập mô tả và chọn ít nhất một sản phẩm.');
       return;
     }
+    if (loading) return; // Tránh gửi trùng khi đang xử lý
     setLoading(true);
+    setStage('Đang gửi yêu cầu...');
     try {
       const response = await axios.post(
-        `${API_URL}/text2img`,
+        `${API_URL}/jobs/text2img`,
         {
           prompt: textPrompt,
           size_choice: sizeChoice,
@@ -58,15 +96,15 @@ function App() {
           product_codes: productCodes
         },
         {
-          headers: { 'Authorization': 'Bearer YOUR_API_KEY_HERE' }, // Thay bằng API key thực tế
-          responseType: 'blob'
+          headers: { 'Authorization': `Bearer ${API_KEY}` }
         }
       );
-      const imageUrl = URL.createObjectURL(response.data);
+      const imageUrl = await waitForJob(response.data.data.events_url, setStage);
       setGeneratedImage(imageUrl);
     } catch (error) {
       alert('Lỗi khi tạo ảnh: ' + (error.response?.data?.detail || error.message));
     }
+    setStage('');
     setLoading(false);
   };
 
@@ -76,7 +114,9 @@ function App() {
       alert('Vui lòng tải ảnh lên, nhập vị trí và chọn một sản phẩm.');
       return;
     }
+    if (loading) return; // Tránh gửi trùng khi đang xử lý
     setLoading(true);
+    setStage('Đang gửi yêu cầu...');
     const formData = new FormData();
     formData.append('image', imageFile);
     formData.append('position', position);
@@ -85,21 +125,21 @@ function App() {
     formData.append('product_codes', JSON.stringify(productCodes));
     try {
       const response = await axios.post(
-        `${API_URL}/img2img`,
+        `${API_URL}/jobs/img2img`,
         formData,
         {
           headers: {
-            'Authorization': 'Bearer YOUR_API_KEY_HERE', // Thay bằng API key thực tế
+            'Authorization': `Bearer ${API_KEY}`,
             'Content-Type': 'multipart/form-data'
-          },
-          responseType: 'blob'
+          }
         }
       );
-      const imageUrl = URL.createObjectURL(response.data);
+      const imageUrl = await waitForJob(response.data.data.events_url, setStage);
       setGeneratedImage(imageUrl);
     } catch (error) {
       alert('Lỗi khi xử lý ảnh: ' + (error.response?.data?.detail || error.message));
     }
+    setStage('');
     setLoading(false);
   };
 
@@ -192,6 +232,7 @@ function App() {
             <button type="submit" disabled={loading}>
               {loading ? <LoadingSpinner /> : 'Tạo ảnh'}
             </button>
+            {stage && <p className="job-stage">{stage}</p>}
           </form>
         </div>
       )}
@@ -244,6 +285,7 @@ function App() {
             <button type="submit" disabled={loading}>
               {loading ? <LoadingSpinner /> : 'Xử lý ảnh'}
             </button>
+            {stage && <p className="job-stage">{stage}</p>}
           </form>
         </div>
       )}
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# main.py reads its settings at import time, so they have to be in place before the tests import it
+os.environ.setdefault("SAVE_DIR", tempfile.mkdtemp(prefix="casla-tests-"))
+os.environ.setdefault("API_KEY_TOKEN", "test")
+# Same module path as "uvicorn main:app --app-dir app"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
@@ -0,0 +1,141 @@
+import asyncio
+import uuid
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_scheduler(monkeypatch):
+    # One upstream slot, so a test can hold it and keep everything else queued
+    monkeypatch.setattr(main, "single_flight", main.SingleFlight())
+    monkeypatch.setattr(main, "upstream_scheduler", main.UpstreamScheduler(1, 10))
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+
+def test_last_caller_leaving_cancels_a_call_still_waiting_for_a_slot():
+    reached_upstream = []
+
+    async def generate():
+        async with main.upstream_scheduler.slot("client", main.LANE_INTERACTIVE):
+            reached_upstream.append(True)
+
+    async def scenario():
+        async with main.upstream_scheduler.slot("other", main.LANE_INTERACTIVE):
+            caller = asyncio.create_task(main.single_flight.do("key", generate))
+            await settle()
+            assert main.upstream_scheduler.waiting == 1
+            assert main.single_flight.cancellable(caller)
+
+            caller.cancel()
+            await asyncio.gather(caller, return_exceptions=True)
+            await settle()
+            assert main.single_flight.in_flight() == 0
+            assert main.upstream_scheduler.waiting == 0
+        await settle()
+
+    asyncio.run(scenario())
+    assert reached_upstream == []
+    assert main.single_flight.stats["abandoned"] == 1
+
+
+def test_call_keeps_running_for_the_callers_that_stay():
+    async def generate():
+        async with main.upstream_scheduler.slot("client", main.LANE_INTERACTIVE):
+            return "result"
+
+    async def scenario():
+        async with main.upstream_scheduler.slot("other", main.LANE_INTERACTIVE):
+            leaving = asyncio.create_task(main.single_flight.do("key", generate))
+            staying = asyncio.create_task(main.single_flight.do("key", generate))
+            await settle()
+            leaving.cancel()
+            await asyncio.gather(leaving, return_exceptions=True)
+            assert main.single_flight.in_flight() == 1
+        return await staying
+
+    assert asyncio.run(scenario()) == "result"
+    assert main.single_flight.stats == {"calls": 1, "shared": 1, "abandoned": 0}
+
+
+def test_call_holding_a_slot_finishes_after_its_callers_leave():
+    finish = asyncio.Event()
+    finished = []
+
+    async def generate():
+        async with main.upstream_scheduler.slot("client", main.LANE_INTERACTIVE):
+            await finish.wait()
+            finished.append(True)
+
+    async def scenario():
+        caller = asyncio.create_task(main.single_flight.do("key", generate))
+        await settle()
+        assert not main.single_flight.cancellable(caller)
+
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        assert main.single_flight.in_flight() == 1
+        finish.set()
+        await settle()
+
+    asyncio.run(scenario())
+    assert finished == [True]
+
+
+def make_job_request() -> main.GenerateRequest:
+    return main.GenerateRequest(prompt=f"kitchen {uuid.uuid4().hex}", size_choice="1024x768",
+                                product_codes=["C1012 Glacier White"])
+
+
+def test_cancelling_a_queued_job_stops_its_generation(monkeypatch):
+    submitted = []
+
+    async def txt2img(prompt, width, height, product_codes, save_path, on_submit=None):
+        submitted.append(prompt)
+
+    monkeypatch.setattr(main, "txt2img", txt2img)
+
+    async def scenario():
+        manager = main.JobManager(10, 60, main.shared_state)
+        async with main.upstream_scheduler.slot("other", main.LANE_INTERACTIVE):
+            job = manager.submit("text2img", {"request": make_job_request(), "client_id": "client"})
+            await settle()
+            assert job.stage == "queued"
+            assert await manager.cancel(job)
+            await job.done.wait()
+        await settle()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == "cancelled"
+    assert submitted == []
+    # The journal gives the key up, so the next request for it generates instead of waiting
+    rows = main.journal._execute("SELECT key FROM generations WHERE status = 'submitting'")
+    assert rows == []
+
+
+def test_job_sent_upstream_cannot_be_cancelled(monkeypatch):
+    finish = asyncio.Event()
+
+    async def txt2img(prompt, width, height, product_codes, save_path, on_submit=None):
+        await finish.wait()
+        save_path.write_bytes(main.PNG_SIGNATURE)
+
+    monkeypatch.setattr(main, "txt2img", txt2img)
+
+    async def scenario():
+        manager = main.JobManager(10, 60, main.shared_state)
+        job = manager.submit("text2img", {"request": make_job_request(), "client_id": "client"})
+        await settle()
+        assert not await manager.cancel(job)
+        finish.set()
+        await job.done.wait()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == "succeeded"